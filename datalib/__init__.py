@@ -3,6 +3,11 @@
 """
 
 
+import os
+import shutil
+import tempfile
+
+import numpy as np
 from absl import logging
 
 from datalib import cifar10
@@ -14,4 +19,25 @@ def download(dir, dataset):
     if globals().get(dataset) is None:
         logging.error('Dataset %s not found', dataset)
         raise ValueError(f"Dataset {dataset} not found")
-    globals()[dataset].download(f"{dir}/{dataset}")
\ No newline at end of file
+    globals()[dataset].download(f"{dir}/{dataset}")
+
+
+def unpack(dir, dataset):
+    """
+    Convert the compressed dataset file within a directory into a directory of uncompressed .npy files, one for each
+    array, so that they may be memory-mapped. The conversion only happens once, and the path to the resulting directory
+    is returned.
+    """
+    path = f"{dir}/{dataset}"
+    if os.path.isdir(path):
+        return path
+    logging.info(f"Unpacking {path}.npz to {path}")
+    tmp = tempfile.mkdtemp(prefix=f".{dataset}-", dir=dir)
+    with np.load(f"{path}.npz") as ds:
+        for k in ds.files:
+            np.save(f"{tmp}/{k}.npy", ds[k])
+    try:
+        os.rename(tmp, path)
+    except OSError:  # another process has already unpacked the dataset
+        shutil.rmtree(tmp)
+    return path
\ No newline at end of file
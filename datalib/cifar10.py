@@ -11,6 +11,12 @@ import numpy as np
 from absl import logging
 
 
+SCALE = 1 / 255
+"""Scale that normalizes the uint8 pixel values to the range [0, 1]."""
+OFFSET = 0.0
+"""Offset applied to the scaled pixel values."""
+
+
 def load():
     """Load the CIFAR-10 dataset."""
     X, y = skds.fetch_openml('CIFAR_10', return_X_y=True)
@@ -18,9 +24,8 @@ def load():
 
 
 def preprocess(X, y):
-    """Preprocess the CIFAR-10 dataset."""
-    X = skp.MinMaxScaler().fit_transform(X)
-    X = X.reshape(-1, 32, 32, 3).astype(np.float32)
+    """Preprocess the CIFAR-10 dataset, the pixel values are kept as uint8 and are normalized by the scale and offset."""
+    X = X.reshape(-1, 32, 32, 3).astype(np.uint8)
     y = skp.LabelEncoder().fit_transform(y).astype(np.int8)
     return X, y
 
@@ -36,5 +41,5 @@ def download(path):
     X, y = preprocess(X, y)
     logging.info(f"Done. Saving as a compressed file to {fn}")
     os.makedirs(dir, exist_ok=True)
-    np.savez_compressed(fn, X=X, y=y, train=(np.arange(len(y)) < 50_000))
+    np.savez_compressed(fn, X=X, y=y, train=(np.arange(len(y)) < 50_000), scale=SCALE, offset=OFFSET)
     logging.info("Finished dataset download.")
\ No newline at end of file
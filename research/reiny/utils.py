@@ -20,28 +20,37 @@ def unzero(x):
 
 
 class Dataset:
-    def __init__(self, X, y, train):
+    def __init__(self, X, y, train, scale=1.0, offset=0.0):
         self.X, self.y, self.train_idx = X, y, train
         self.classes = np.unique(self.y).shape[0]
+        self.scale, self.offset = scale, offset
 
     def train(self) -> tuple[np.ndarray, np.ndarray]:
-        """Get the training subset"""
-        return self.X[self.train_idx], self.y[self.train_idx]
+        """Get the training subset, with the samples normalized into float32"""
+        return self.normalize(self.X[self.train_idx]), self.y[self.train_idx]
 
     def test(self) -> tuple[np.ndarray, np.ndarray]:
-        """Get the testing subset"""
-        return self.X[~self.train_idx], self.y[~self.train_idx]
+        """Get the testing subset, with the samples normalized into float32"""
+        return self.normalize(self.X[~self.train_idx]), self.y[~self.train_idx]
+
+    def normalize(self, X):
+        """Convert integer typed samples into float32 samples, float samples are returned as is"""
+        if np.issubdtype(X.dtype, np.integer):
+            return X.astype(np.float32) * np.float32(self.scale) + np.float32(self.offset)
+        return X
 
     def get_iter(self, split, batch_size=None, filter=None, map=None, rng=np.random.default_rng()):
         """Generate an iterator out of the dataset"""
-        X, y = self.train() if split == 'train' else self.test()
-        X, y = X.copy(), y.copy()
+        split_idx = self.train_idx if split == 'train' else ~self.train_idx
+        X, y = self.X[split_idx], self.y[split_idx]
         if filter is not None:
             idx = filter(y)
             X, y = X[idx], y[idx]
         if map is not None:
-            X, y = map(X, y)
-        return ymir.mp.datasets.DataIter(X, y, batch_size, self.classes, rng)
+            X, y = map(self.normalize(X), y)
+            return ymir.mp.datasets.DataIter(X, y, batch_size, self.classes, rng)
+        # The samples are kept in their stored type, and normalized on device as they are used
+        return ymir.mp.datasets.DataIter(X, y, batch_size, self.classes, rng, scale=self.scale, offset=self.offset)
     
     def fed_split(self, batch_sizes, mappings=None):
         """Divide the dataset for federated learning"""
@@ -56,6 +65,8 @@ def load(dataset, dir="data"):
         datalib.download(dir, dataset)
     ds = np.load(f"{dir}/{dataset}.npz")
     X, y, train = ds['X'], ds['y'], ds['train']
+    if 'scale' in ds.files:
+        return Dataset(X, y, train, scale=float(ds['scale']), offset=float(ds['offset']))
     return Dataset(X, y, train)
 
 
@@ -0,0 +1,101 @@
+"""
+Evaluation of the sketched history mode of the history based captains against their exact form, reporting, for each
+sketch dimension k, the final accuracy and attack success rate of the model, and the mean absolute difference between
+the sketched and exact scaling of the updates.
+"""
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+import haiku as hk
+import optax
+import pandas as pd
+from absl import app
+from absl import flags
+
+from tqdm import trange
+
+import ymir
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("alg", "foolsgold", "History based algorithm to evaluate, one of foolsgold, contra, or viceroy")
+flags.DEFINE_string("dataset", "mnist", "Dataset to use")
+flags.DEFINE_list("ks", ["16", "64", "256", "1024", "4096"], "Sketch dimensions to evaluate")
+flags.DEFINE_integer("clients", 10, "Number of clients in the network")
+flags.DEFINE_float("aper", 0.3, "Percentage of label flipping adversaries in the network")
+flags.DEFINE_integer("rounds", 500, "Number of rounds of training")
+
+
+def main(_):
+    results = pd.DataFrame(columns=["k", "accuracy", "asr", "alpha error"])
+    for k in [None] + [int(k) for k in FLAGS.ks]:
+        results.loc[len(results)] = evaluate(k)
+        print(results.iloc[-1].to_dict())
+    fn = f"sketch_{FLAGS.alg}_{FLAGS.dataset}.csv"
+    results.to_csv(fn, index=False)
+    print(results.to_string(index=False))
+    print(f"Written results to {fn}")
+
+
+def evaluate(k, attack_from=0, attack_to=1):
+    """Train a model with the captain sketched to k dimensions, or exact if k is None, and return the results"""
+    rng = np.random.default_rng(0)
+    dataset = ymir.mp.datasets.load(FLAGS.dataset)
+    num_adv = int(FLAGS.clients * FLAGS.aper)
+    batch_sizes = [8 for _ in range(FLAGS.clients)]
+    data = dataset.fed_split(batch_sizes, ymir.mp.distributions.cache(ymir.mp.distributions.lda), rng)
+    test_eval = dataset.get_iter("test", rng=rng)
+
+    net = hk.without_apply_rng(hk.transform(lambda x: ymir.mp.models.LeNet_300_100(dataset.classes, x)))
+    client_opt = optax.sgd(0.01)
+    params = net.init(jax.random.PRNGKey(42), next(test_eval)[0])
+    client_opt_state = client_opt.init(params)
+    loss = ymir.mp.losses.cross_entropy_loss(net, dataset.classes)
+    network = ymir.mp.network.Network()
+    network.add_controller("main", server=True)
+    for i, d in enumerate(data):
+        c = ymir.regiment.Scout(client_opt, client_opt_state, loss, d, 1)
+        if i >= FLAGS.clients - num_adv:
+            ymir.regiment.adversaries.labelflipper.convert(c, dataset, attack_from, attack_to)
+        network.add_host("main", c)
+
+    server_opt = optax.sgd(1)
+    server_opt_state = server_opt.init(params)
+    alg = getattr(ymir.garrison, FLAGS.alg)
+    server_kwargs = {"k": FLAGS.clients - num_adv} if FLAGS.alg == "contra" else {}
+    # Each captain has its own identically seeded generator, so the shadow captain neither changes what the sketched
+    # captain and the network draw, nor draws differently from the sketched captain
+    captain = alg.Captain(
+        params, server_opt, server_opt_state, network, np.random.default_rng(1), sketch=k, **server_kwargs
+    )
+    # The exact captain shadows the sketched one, seeing the same updates, to measure the error of the sketched scaling
+    exact = None if k is None else alg.Captain(
+        params, server_opt, server_opt_state, network, np.random.default_rng(1), **server_kwargs
+    )
+
+    errors = []
+    for _ in trange(FLAGS.rounds):
+        all_grads = network(captain.params, rng)
+        captain.update(all_grads)
+        alpha = captain.scale(all_grads)
+        if exact is not None:
+            exact.update(all_grads)
+            errors.append(float(jnp.mean(jnp.abs(alpha - exact.scale(all_grads)))))
+        all_grads = ymir.garrison.captain.apply_scale(alpha, all_grads)
+        captain.params, captain.opt_state = captain.update_params(
+            captain.params, captain.opt_state, ymir.garrison.captain.sum_grads(all_grads)
+        )
+
+    X, y = next(test_eval)
+    preds = np.argmax(net.apply(captain.params, X), axis=-1)
+    return {
+        "k": "exact" if k is None else k,
+        "accuracy": float(np.mean(preds == y)),
+        "asr": float(np.mean(preds[y == attack_from] == attack_to)),
+        "alpha error": float(np.mean(errors)) if errors else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -64,11 +64,17 @@ def main(_):
     N = T - A
     batch_sizes = [8 for _ in range(N + A)]
     if DATASET != 'kddcup99':
-        data = DS.fed_split(batch_sizes, partial(ymir.mp.distributions.lda, alpha=0.5 if ALG in ['contra', 'foolsgold', 'viceroy'] else 1000), rng)
+        data = DS.fed_split(
+            batch_sizes,
+            ymir.mp.distributions.cache(partial(ymir.mp.distributions.lda, alpha=0.5 if ALG in ['contra', 'foolsgold', 'viceroy'] else 1000)),
+            rng
+        )
     else:
         data = DS.fed_split(
             batch_sizes,
-            partial(ymir.mp.distributions.assign_classes, classes=[[(i + 1 if i >= 11 else i) % DS.classes, 11] for i in range(T)]),
+            ymir.mp.distributions.cache(
+                partial(ymir.mp.distributions.assign_classes, classes=[[(i + 1 if i >= 11 else i) % DS.classes, 11] for i in range(T)])
+            ),
             rng
         )
 
@@ -86,7 +92,7 @@ def main(_):
             }[DATASET], ATTACK_FROM, ATTACK_TO, no_label=True)
         )
 
-    if ALG == "krum":
+    if ALG in ["krum", "trimmed_mean", "bulyan"]:
         model = getattr(ymir.garrison, ALG).Captain(params, opt, opt_state, network, rng, clip=A)
     elif ALG == "contra":
         model = getattr(ymir.garrison, ALG).Captain(params, opt, opt_state, network, rng, k=N)
@@ -136,7 +142,7 @@ def write_results(results, fn):
 
 
 def create_network(num_honest, num_adv, attack, params, opt, opt_state, loss, data, batch_sizes, ds, dataset, alg, att_from, att_to, victim):
-    if alg == "krum":
+    if alg in ["krum", "trimmed_mean", "bulyan"]:
         server_kwargs = {"clip": num_adv}
     elif alg == "contra":
         server_kwargs = {"k": num_honest}
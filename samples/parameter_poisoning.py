@@ -41,7 +41,10 @@ def main(_):
     
     if attack == "smp":
         # Setup for the stealthy model poisoning attack
-        adv_loss = ymir.mp.losses.smp_loss(net, 10, loss, test_eval.X[:100], test_eval.y[:100], 10)
+        # The iterator holds the indices of the test split within the shared, unnormalized, samples
+        smp_idx = test_eval.idx[:100]
+        smp_X = ymir.mp.datasets.normalize(test_eval.X[smp_idx], test_eval.scale, test_eval.offset)
+        adv_loss = ymir.mp.losses.smp_loss(net, 10, loss, smp_X, test_eval.y[smp_idx], 10)
         adv_opt = ymir.mp.optimizers.smp_opt(client_opt, 0.0001)
         adv_opt_state = adv_opt.init(params)
         for i in range(num_adversaries):
@@ -1,3 +1,7 @@
+import gc
+from unittest import mock
+import weakref
+
 from absl.testing import absltest
 from absl.testing import parameterized
 
@@ -9,6 +13,7 @@ import jax
 import jax.numpy as jnp
 
 import ymir
+import ymirlib
 
 @chex.dataclass
 class Client:
@@ -16,8 +21,9 @@ class Client:
     epochs: int
 
 class Network:
-    def __init__(self, clients):
+    def __init__(self, clients, delta=False):
         self.clients = clients
+        self.delta = delta
 
     def __len__(self):
         return len(self.clients)
@@ -27,6 +33,34 @@ class Params:
     w: chex.ArrayDevice
     b: chex.ArrayDevice
 
+class Linear:
+    def apply(self, params, X):
+        return jnp.stack((X[:, :10] @ params.w, X[:, 10:] @ params.b), axis=1)
+
+def _network(opt, opt_state, C=1.0, nclients=10, device=True, stacked=False):
+    rng = np.random.default_rng(0)
+    X = rng.random((4 * nclients, 12)).astype(np.float32)
+    y = (X.sum(axis=1) > 6).astype(np.int8)
+    dataset = ymir.mp.datasets.Dataset(X, y, np.full(len(y), True), device=device)
+    loss = ymir.mp.losses.cross_entropy_loss(Linear(), 2)
+    network = ymir.mp.network.Network(C, stacked=stacked)
+    network.add_controller("main", server=True)
+    for d in dataset.fed_split([4 for _ in range(nclients)], rng=rng):
+        network.add_host("main", ymir.regiment.Scout(opt, opt_state, loss, d, 2))
+    return network
+
+
+def _recursive_krum(G, f, theta):
+    """Select theta of the rows of G by repeatedly applying Krum to the rows not yet selected"""
+    remaining = list(range(len(G)))
+    for _ in range(theta):
+        r = len(remaining)
+        k = min(max(r - f - 2, 1), r - 1)
+        D = ((G[remaining][:, None] - G[remaining][None]) ** 2).sum(axis=2)
+        scores = [np.sort(np.delete(d, i))[:k].sum() for i, d in enumerate(D)]
+        remaining.pop(int(np.argmin(scores)))
+    return np.isin(np.arange(len(G)), remaining, invert=True)
+
 
 class TestAggregators(parameterized.TestCase):
     def setUp(self):
@@ -39,7 +73,9 @@ class TestAggregators(parameterized.TestCase):
     @parameterized.named_parameters(
         [
             {"testcase_name": f"_{server_name=}", "server_name": server_name}
-            for server_name in ["fedavg", "foolsgold", "krum", "norm_clipping", "std_dagmm", "viceroy"]
+            for server_name in [
+                "contra", "fedavg", "foolsgold", "krum", "norm_clipping", "std_dagmm", "viceroy"
+            ]
         ]
     )
     def test_scale_servers(self, server_name):
@@ -63,11 +99,38 @@ class TestAggregators(parameterized.TestCase):
     @parameterized.named_parameters(
         [
             {"testcase_name": f"_{server_name=}", "server_name": server_name}
-            for server_name in ["flguard"]
+            for server_name in ["fedavg", "krum", "norm_clipping"]
         ]
     )
-    def test_aggregate_servers(self, server_name):
+    def test_scale_servers_stacked(self, server_name):
         server = getattr(ymir.garrison, server_name).Captain(self.params, self.opt, self.opt_state, self.network, self.rng)
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_grads = [
+            Params(w=jax.random.uniform(r, (10,), dtype=jnp.float32), b=jax.random.uniform(r, (2,), dtype=jnp.float32))
+            for r in rngs
+        ]
+        matrix = ymir.mp.updates.as_matrix(all_grads)
+        server.update(matrix)
+        alpha = server.scale(matrix)
+        chex.assert_trees_all_close(alpha, server.scale(all_grads))
+        chex.assert_trees_all_close(
+            ymir.garrison.captain.sum_grads(ymir.garrison.captain.apply_scale(alpha, matrix)),
+            ymir.garrison.captain.sum_grads(ymir.garrison.captain.apply_scale(alpha, all_grads)),
+            rtol=1e-5
+        )
+
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{server_name=}", "server_name": server_name}
+            for server_name in ["bulyan", "flguard", "median", "trimmed_mean"]
+        ]
+    )
+    def test_aggregate_servers(self, server_name):
+        # Bulyan requires at least 4f + 3 clients
+        kwargs = {"clip": 1} if server_name == "bulyan" else {}
+        server = getattr(ymir.garrison, server_name).Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng, **kwargs
+        )
         rngs = jax.random.split(jax.random.PRNGKey(0))
         all_weights = [
             Params(
@@ -81,7 +144,383 @@ class TestAggregators(parameterized.TestCase):
         chex.assert_tree_all_finite(update)
         chex.assert_trees_all_equal_dtypes(update, self.params)
 
-        
+    @parameterized.parameters("bulyan", "median", "trimmed_mean")
+    def test_coordinatewise_servers(self, server_name):
+        # Bulyan requires at least 4f + 3 clients
+        kwargs = {"clip": 1} if server_name == "bulyan" else {}
+        server = getattr(ymir.garrison, server_name).Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng, **kwargs
+        )
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_grads = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        alpha, grads = server.aggregate(all_grads)
+        chex.assert_shape(alpha, (len(self.network.clients),))
+        chex.assert_trees_all_close(server.aggregate(ymir.mp.updates.as_matrix(all_grads)), (alpha, grads), rtol=1e-5)
+        # The aggregate is not a reweighting of the updates, so these captains give their shares rather than a scale
+        self.assertFalse(hasattr(server, "scale"))
+        chex.assert_trees_all_close(ymir.garrison.captain.get_scale(server, all_grads), alpha)
+        chex.assert_trees_all_close(
+            server.update(all_grads), server.update_params(self.params, self.opt_state, grads)[0], rtol=1e-5
+        )
+
+    @parameterized.parameters("hdbscan", "mst")
+    def test_flguard_clustering(self, clustering):
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        honest = jnp.concatenate((jnp.ones(6), -jnp.ones(6)))
+        all_weights = [
+            Params(w=x[:10], b=x[10:])
+            for x in (jnp.where(i < 7, honest, -honest) + 0.1 * jax.random.normal(r, (12,)) for i, r in enumerate(rngs))
+        ]
+        server = ymir.garrison.flguard.Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng, clustering=clustering
+        )
+        labels = np.asarray(server.cluster(
+            ymir.garrison.flguard.distances(ymir.mp.updates.gram(all_weights)), len(all_weights) // 2 + 1
+        ))
+        self.assertTrue(np.all(labels[:7] == labels[0]) and labels[0] != -1)
+        self.assertTrue(np.all(labels[7:] != labels[0]))
+        update = server.update(all_weights)
+        chex.assert_trees_all_equal_shapes(update, self.params)
+        chex.assert_tree_all_finite(update)
+        chex.assert_trees_all_equal_dtypes(update, self.params)
+
+    def test_flguard_all_noise(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_weights = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        server = ymir.garrison.flguard.Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng,
+            clustering=lambda D, min_cluster_size: np.full(len(D), -1)
+        )
+        chex.assert_trees_all_equal(server.update(all_weights), self.params)
+
+    def test_flguard_delta(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_weights = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        all_deltas = [jax.tree_map(jnp.subtract, w, self.params) for w in all_weights]
+        delta_network = Network(self.network.clients, delta=True)
+        for stacked in [False, True]:
+            server = ymir.garrison.flguard.Captain(
+                self.params, self.opt, self.opt_state, self.network, np.random.default_rng(0), clustering="mst"
+            )
+            delta_server = ymir.garrison.flguard.Captain(
+                self.params, self.opt, self.opt_state, delta_network, np.random.default_rng(0), clustering="mst"
+            )
+            chex.assert_trees_all_close(
+                server.update(all_weights),
+                delta_server.update(ymir.mp.updates.as_matrix(all_deltas) if stacked else all_deltas),
+                rtol=1e-4, atol=1e-5
+            )
+
+    @parameterized.parameters(("fedavg", 1.0), ("fedavg", 0.5), ("norm_clipping", 1.0), ("norm_clipping", 0.5))
+    def test_compiled_step(self, server_name, C):
+        def captain(device=True):
+            return getattr(ymir.garrison, server_name).Captain(
+                self.params, self.opt, self.opt_state, _network(self.opt, self.opt_state, C, device=device),
+                np.random.default_rng(1)
+            )
+
+        server = captain()
+        alphas = [server.step()[0] for _ in range(3)]
+        compiled_server = captain()
+        compiled_alphas = jnp.concatenate((compiled_server.compiled_step(2), compiled_server.compiled_step()))
+        chex.assert_shape(compiled_alphas, (3, len(self.network.clients)))
+        chex.assert_trees_all_close(server.params, compiled_server.params, rtol=1e-5, atol=1e-6)
+        if C == 1.0:
+            # The alphas of step are in the order that the clients were sampled, while the compiled alphas are by id
+            chex.assert_trees_all_close(jnp.sort(jnp.stack(alphas)), jnp.sort(compiled_alphas), rtol=1e-5)
+        with self.assertRaises(ValueError):
+            captain(device=False).compiled_step()
+
+    def test_fedavg_participation(self):
+        for stacked in [False, True]:
+            network = _network(self.opt, self.opt_state, 0.5, stacked=stacked)
+            server = ymir.garrison.fedavg.Captain(self.params, self.opt, self.opt_state, network, np.random.default_rng(0))
+            alpha, all_grads = server.step()
+            chex.assert_shape(alpha, (len(network) // 2,))
+            # The participating clients share the whole aggregate
+            chex.assert_trees_all_close(alpha, jnp.full(len(network) // 2, 1 / (len(network) // 2)))
+            chex.assert_tree_all_finite(server.params)
+
+    def test_foolsgold(self):
+        histories = jax.random.normal(jax.random.PRNGKey(0), (8, 12))
+        histories = histories.at[5:].set(histories[5] + 0.01 * histories[5:])
+        alpha = ymir.garrison.foolsgold.foolsgold(histories, 1.0)
+        chex.assert_shape(alpha, (8,))
+        chex.assert_type(alpha, jnp.float32)
+        self.assertGreater(alpha[:5].min(), alpha[5:].max())
+        chex.assert_tree_all_finite(ymir.garrison.foolsgold.foolsgold(jnp.ones((8, 12)), 1.0))
+
+    def test_contra(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_grads = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        alphas = []
+        for _ in range(2):
+            server = ymir.garrison.contra.Captain(
+                self.params, self.opt, self.opt_state, self.network, np.random.default_rng(42), C=0.5, k=4
+            )
+            for _ in range(3):
+                server.update(all_grads)
+                alphas.append(server.scale(all_grads))
+            chex.assert_shape(server.reps, (len(self.network.clients),))
+        chex.assert_trees_all_equal(alphas[:3], alphas[3:])
+        for alpha in alphas:
+            chex.assert_tree_all_finite(alpha)
+            self.assertLessEqual(int(jnp.sum(alpha > 0)), 5)
+
+    def test_krum(self):
+        G = jax.random.normal(jax.random.PRNGKey(0), (11, 12))
+        G = G.at[8:].add(10.0)
+        distances = jnp.sum((G[:, None] - G[None]) ** 2, axis=-1)
+        expected = jnp.sort(distances, axis=1)[:, 1:7].sum(axis=1)
+        for block_size in [1, 4, 64]:
+            chex.assert_trees_all_close(ymir.garrison.krum.scores(G, 6, block_size), expected, rtol=1e-4)
+        krum_idx, multi_alpha = ymir.garrison.krum.select(G, 3, 4)
+        self.assertEqual(krum_idx, jnp.argmin(expected))
+        chex.assert_trees_all_equal(multi_alpha, jnp.array([1.0] * 8 + [0.0] * 3))
+        server = ymir.garrison.krum.Captain(self.params, self.opt, self.opt_state, self.network, self.rng, multi=False)
+        all_grads = ymir.mp.updates.UpdateMatrix(G, lambda g: g)
+        self.assertEqual(server.scale(all_grads).sum(), 1.0)
+
+    def test_coordinatewise(self):
+        rng = np.random.default_rng(0)
+        G = jnp.array(rng.integers(-3, 3, size=(11, 50)), dtype=jnp.float32)
+        G = G.at[:, :25].add(jnp.array(rng.normal(size=(11, 25)), dtype=jnp.float32))
+        ordered = np.sort(np.asarray(G), axis=0)
+        for block_size in [8, 64]:
+            for aggregate, expected in [
+                (ymir.garrison.median.median(G, block_size), np.median(ordered, axis=0)),
+                (ymir.garrison.trimmed_mean.trimmed_mean(G, 3, block_size), ordered[3:-3].mean(axis=0)),
+            ]:
+                g, alpha = aggregate
+                np.testing.assert_allclose(g, expected, rtol=1e-5, atol=1e-6)
+                self.assertAlmostEqual(float(alpha.sum()), 1.0, places=5)
+            g, alpha = ymir.garrison.bulyan.bulyan(G, 2, block_size)
+            selected = np.asarray(G)[_recursive_krum(np.asarray(G), 2, 7)]
+            distances = np.abs(selected - np.median(selected, axis=0))
+            # Ties in the distances to the median may be broken either way, so only the closest values are compared
+            closest = np.take_along_axis(selected, np.argsort(distances, axis=0, kind='stable')[:3], axis=0)
+            np.testing.assert_allclose(g[:25], closest.mean(axis=0)[:25], rtol=1e-5, atol=1e-6)
+            self.assertAlmostEqual(float(alpha.sum()), 1.0, places=5)
+        with self.assertRaises(ValueError):
+            ymir.garrison.bulyan.bulyan(G[:10], 2)
+        # Identical values aggregate to exactly themselves, despite the rounding of the tied weights
+        G = jnp.full((7, 7), 0.3, dtype=jnp.float32)
+        for g, _ in [
+            ymir.garrison.median.median(G, 4), ymir.garrison.trimmed_mean.trimmed_mean(G, 1, 4),
+            ymir.garrison.bulyan.bulyan(G, 1, 4)
+        ]:
+            chex.assert_trees_all_equal(g, G[0])
+
+    def test_order_statistic(self):
+        X = np.random.default_rng(0).normal(size=(9, 50)) * 100
+        for dtype in [jnp.float16, jnp.bfloat16, jnp.float32]:
+            X_d = jnp.asarray(X, dtype=dtype)
+            ordered = np.sort(np.asarray(X_d, dtype=np.float32), axis=0)
+            for k in [0, 4, 8]:
+                statistic = ymir.garrison.trimmed_mean.order_statistic(X_d, k)
+                chex.assert_type(statistic, dtype)
+                np.testing.assert_array_equal(np.asarray(statistic, dtype=np.float32), ordered[k])
+
+    def test_history(self):
+        histories = ymir.garrison.history.History(4, 3, omega=0.5)
+        self.assertLen(histories, 4)
+        G = jnp.arange(12, dtype=jnp.float32).reshape(4, 3)
+        histories.update(G)
+        H = histories.update(G)
+        chex.assert_trees_all_close(H, 1.5 * G)
+        chex.assert_trees_all_close(histories.H, H)
+        chex.assert_type(H, jnp.float32)
+
+    def test_history_ids(self):
+        histories = ymir.garrison.history.History(4, 3, omega=0.5)
+        G = jnp.ones((4, 3))
+        histories.update(G)
+        histories.update(2 * G[:2], ids=jnp.array([3, 1]))
+        chex.assert_trees_all_close(histories.H, jnp.array([1.0, 2.5, 1.0, 2.5])[:, None] * G)
+        chex.assert_trees_all_close(histories.get(jnp.array([1, 0])), jnp.array([[2.5] * 3, [1.0] * 3]))
+
+    def test_history_tree_update(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), 4)
+        all_grads = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        G = ymir.mp.updates.as_matrix(all_grads).G
+        for ids in [None, jnp.array([6, 2, 9, 0])]:
+            tree_histories = ymir.garrison.history.History(10, 12, omega=0.5)
+            matrix_histories = ymir.garrison.history.History(10, 12, omega=0.5)
+            for _ in range(2):
+                if ids is None:
+                    tree_histories.update(all_grads + all_grads + all_grads[:2])
+                    matrix_histories.update(jnp.concatenate([G, G, G[:2]]))
+                else:
+                    tree_histories.update(all_grads, ids)
+                    matrix_histories.update(G, ids)
+            chex.assert_trees_all_close(tree_histories.H, matrix_histories.H)
+
+    def test_history_sketch(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), 4)
+        all_grads = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        G = ymir.mp.updates.as_matrix(all_grads).G
+        sketch = ymir.garrison.history.CountSketch(12, 5)
+        S = sketch(G)
+        chex.assert_shape(S, (4, 5))
+        chex.assert_trees_all_close(sketch(all_grads), S, atol=1e-6)
+        wide = ymir.garrison.history.CountSketch(12, 12 * 64)(G)
+        chex.assert_trees_all_close(jnp.linalg.norm(wide, axis=1), jnp.linalg.norm(G, axis=1), rtol=1e-5)
+        histories = ymir.garrison.history.History(4, 12, sketch=5, gram=True)
+        histories.update(all_grads)
+        chex.assert_trees_all_close(histories.H, S, atol=1e-6)
+        chex.assert_trees_all_close(histories.project(all_grads), S, atol=1e-6)
+
+    def test_sketch_similarity_error(self):
+        # The error of a sketched inner product of unit vectors has a standard deviation of at most sqrt(2 / k), so the
+        # cosine similarities are bounded to within 3 of those of the exact updates
+        d, k = 20_000, 1024
+        common_key, noise_key = jax.random.split(jax.random.PRNGKey(0))
+        common = jax.random.normal(common_key, (d,))
+        G = 0.5 * common + jax.random.normal(noise_key, (10, d))
+        G = G.at[7:].set(2 * common + 0.1 * G[7:])
+        cs = ymirlib.cosine_similarity(G)
+        for seed in range(3):
+            S = ymir.garrison.history.CountSketch(d, k, jax.random.PRNGKey(seed + 1))(G)
+            self.assertLess(float(jnp.max(jnp.abs(ymirlib.cosine_similarity(S) - cs))), 3 * np.sqrt(2 / k))
+
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{server_name=}", "server_name": server_name}
+            for server_name in ["contra", "foolsgold", "viceroy"]
+        ]
+    )
+    def test_sketched_servers(self, server_name):
+        kwargs = {"C": 0.5, "k": 2} if server_name == "contra" else {}
+        server = getattr(ymir.garrison, server_name).Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng, sketch=4, **kwargs
+        )
+        chex.assert_shape(server.histories.H, (len(self.network), 4))
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_grads = [Params(w=jax.random.uniform(r, (10,)), b=jax.random.uniform(r, (2,))) for r in rngs]
+        for _ in range(2):
+            server.update(all_grads)
+            alpha = server.scale(all_grads)
+        chex.assert_shape(alpha, (len(self.network.clients),))
+        chex.assert_tree_all_finite(alpha)
+
+    def test_memmap_history(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), 4)
+        all_grads = [Params(w=jax.random.normal(r, (10,)), b=jax.random.normal(r, (2,))) for r in rngs]
+        for sketch in [None, 5]:
+            histories = ymir.garrison.history.History(10, 12, omega=0.5, sketch=sketch)
+            memmap = ymir.garrison.history.MemmapHistory(10, 12, omega=0.5, sketch=sketch, chunk_size=8)
+            for ids in [None, jnp.array([6, 2, 9, 0]), jnp.array([2, 3, 4, 5])]:
+                grads = all_grads + all_grads + all_grads[:2] if ids is None else all_grads
+                histories.update(grads, ids)
+                memmap.update(ymir.mp.updates.as_matrix(grads), ids)
+            chex.assert_trees_all_close(memmap.get(), histories.get(), atol=1e-5)
+            chex.assert_trees_all_close(memmap.get(jnp.array([2, 0])), histories.get(jnp.array([2, 0])), atol=1e-5)
+            for select in [None, jnp.array([5, 3, 0])]:
+                chex.assert_trees_all_close(memmap.similarity(select), histories.similarity(select), atol=1e-5)
+
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{server_name=}", "server_name": server_name}
+            for server_name in ["contra", "foolsgold", "viceroy"]
+        ]
+    )
+    def test_memmap_servers(self, server_name):
+        kwargs = {"C": 0.5, "k": 2} if server_name == "contra" else {}
+        server = getattr(ymir.garrison, server_name).Captain(
+            self.params, self.opt, self.opt_state, self.network, self.rng, memmap=True, **kwargs
+        )
+        self.assertIsInstance(server.histories, ymir.garrison.history.MemmapHistory)
+        ids = np.array([1, 4, 7, 8, 9])
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(ids))
+        all_grads = ymir.mp.updates.Updates([Params(w=jax.random.uniform(r, (10,)), b=jax.random.uniform(r, (2,))) for r in rngs], ids)
+        for _ in range(2):
+            server.update(all_grads)
+            alpha = server.scale(all_grads)
+        chex.assert_shape(alpha, (len(ids),))
+        chex.assert_tree_all_finite(alpha)
+
+    def test_history_similarity(self):
+        histories = ymir.garrison.history.History(6, 4, omega=0.5, gram=True)
+        for i, ids in enumerate([None, jnp.array([3, 1]), jnp.array([0, 5, 3])]):
+            G = jax.random.normal(jax.random.PRNGKey(i), (6 if ids is None else len(ids), 4))
+            histories.update(G, ids)
+            for select in [None, jnp.array([5, 3, 0])]:
+                chex.assert_trees_all_close(
+                    histories.similarity(select), ymirlib.cosine_similarity(histories.get(select)), atol=1e-5
+                )
+
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{server_name=}", "server_name": server_name, "kwargs": kwargs}
+            for server_name, kwargs in [("contra", {"C": 0.5, "k": 2}), ("foolsgold", {}), ("viceroy", {})]
+        ]
+    )
+    def test_participation(self, server_name, kwargs):
+        server = getattr(ymir.garrison, server_name).Captain(self.params, self.opt, self.opt_state, self.network, self.rng, **kwargs)
+        ids = np.array([1, 4, 7, 8, 9])
+        for i in range(2):
+            rngs = jax.random.split(jax.random.PRNGKey(i), len(ids))
+            all_grads = ymir.mp.updates.Updates(
+                [Params(w=jax.random.uniform(r, (10,)), b=jax.random.uniform(r, (2,))) for r in rngs], ids
+            )
+            server.update(all_grads)
+            alpha = server.scale(all_grads)
+            chex.assert_shape(alpha, (len(ids),))
+            chex.assert_tree_all_finite(alpha)
+        untouched = np.setdiff1d(np.arange(len(self.network)), ids)
+        chex.assert_trees_all_close(server.histories.H[untouched], jnp.zeros((len(untouched), 12)))
+
+    def test_viceroy_scales_once(self):
+        network = _network(self.opt, self.opt_state, device=False)
+        server = ymir.garrison.viceroy.Captain(self.params, self.opt, self.opt_state, network, np.random.default_rng(0))
+        with mock.patch.object(ymir.garrison.viceroy, "scale", wraps=ymir.garrison.viceroy.scale) as scale:
+            for i in range(4):
+                alpha, _ = server.step()
+                self.assertEqual(scale.call_count, 2 * (i + 1))
+        chex.assert_shape(alpha, (len(network),))
+        chex.assert_tree_all_finite(alpha)
+        # The cached scale is reordered to the order that the clients are sampled in
+        ids = np.random.default_rng(1).permutation(len(network))
+        chex.assert_trees_all_close(
+            server.get_history_scale(ids), ymir.garrison.viceroy.scale(server.histories.similarity(ids)), rtol=1e-5
+        )
+
+
+    def test_scale_caches_release_updates(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        for server_name in ["std_dagmm", "viceroy"]:
+            server = getattr(ymir.garrison, server_name).Captain(
+                self.params, self.opt, self.opt_state, self.network, self.rng
+            )
+            all_grads = ymir.mp.updates.Updates(
+                [Params(w=jax.random.uniform(r, (10,)), b=jax.random.uniform(r, (2,))) for r in rngs]
+            )
+            server.update(all_grads)
+            server.scale(all_grads)
+            ref = weakref.ref(all_grads)
+            del all_grads
+            gc.collect()
+            self.assertIsNone(ref())
+
+    def test_std_dagmm_features(self):
+        server = ymir.garrison.std_dagmm.Captain(self.params, self.opt, self.opt_state, self.network, self.rng)
+        rngs = jax.random.split(jax.random.PRNGKey(0), len(self.network.clients))
+        all_grads = [Params(w=jax.random.uniform(r, (10,)), b=jax.random.uniform(r, (2,))) for r in rngs]
+        with mock.patch.object(server, "da_features", wraps=server.da_features) as features:
+            server.update(all_grads)
+            server.scale(all_grads)
+            self.assertEqual(features.call_count, 1)
+        X = ymir.mp.updates.as_matrix(all_grads).G
+        enc, dec = server.da.apply(server.da_params, X)
+        z = server.get_features(all_grads)
+        chex.assert_shape(z, (len(all_grads), 4))
+        for x, e, d, zi in zip(X, enc, dec, z):
+            np.testing.assert_allclose(
+                zi,
+                [e[0], jnp.linalg.norm(x - d) / jnp.linalg.norm(x), optax.cosine_similarity(x, d), jnp.std(x)],
+                rtol=1e-5, atol=1e-6
+            )
+
 
 if __name__ == '__main__':
     absltest.main()
\ No newline at end of file
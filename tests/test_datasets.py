@@ -1,6 +1,11 @@
+import os
+import shutil
+import tempfile
+
 from absl.testing import absltest
 
 import chex
+import jax
 import numpy as np
 
 import ymir
@@ -21,6 +26,70 @@ class TestDatasets(absltest.TestCase):
         dataiter = ymir.mp.datasets.DataIter(self.X, self.y, 500, 2, self.rng)
         self.assertEqual(dataiter.batch_size, len(self.X))
     
+    def test_samplers(self):
+        for sampler in ["choice", "permutation", "replacement"]:
+            dataiter = ymir.mp.datasets.DataIter(self.X, self.y, 8, 2, self.rng, sampler=sampler)
+            X, y = next(dataiter)
+            chex.assert_shape(X, (8, 1))
+            chex.assert_shape(y, (8,))
+            X, y = dataiter.next_n(3)
+            chex.assert_shape(X, (3, 8, 1))
+            chex.assert_shape(y, (3, 8))
+        dataiter = ymir.mp.datasets.DataIter(self.X, self.y, 10, 2, self.rng, sampler="permutation")
+        X = np.concatenate(dataiter.next_n(5)[0])
+        chex.assert_trees_all_close(np.sort(X, axis=0), np.sort(self.X, axis=0))
+        with self.assertRaises(ValueError):
+            ymir.mp.datasets.DataIter(self.X, self.y, 8, 2, self.rng, sampler="unknown")
+
+    def test_normalize(self):
+        X = self.rng.integers(0, 256, size=(50, 2), dtype=np.uint8)
+        dataiter = ymir.mp.datasets.DataIter(X, self.y, 8, 2, self.rng, scale=1 / 255, offset=0.0)
+        bX, _ = next(dataiter)
+        chex.assert_type(bX, np.float32)
+        self.assertTrue((bX >= 0).all() and (bX <= 1).all())
+        rX, _ = dataiter.next_n(2, raw=True)
+        chex.assert_type(rX, np.uint8)
+        nX = ymir.mp.datasets.normalize(rX, dataiter.scale, dataiter.offset)
+        chex.assert_trees_all_close(nX, rX.astype(np.float32) / 255)
+        chex.assert_trees_all_close(ymir.mp.datasets.normalize(self.X, 2.0, 1.0), self.X)
+
+    def test_Prefetcher(self):
+        dataiter = ymir.mp.datasets.DataIter(self.X, self.y, 8, 2, np.random.default_rng(0))
+        prefetcher = ymir.mp.datasets.Prefetcher(ymir.mp.datasets.DataIter(self.X, self.y, 8, 2, np.random.default_rng(0)), n=2)
+        self.assertEqual(prefetcher.batch_size, 8)
+        for _ in range(3):
+            chex.assert_trees_all_close(prefetcher.next_n(2), dataiter.next_n(2))
+        X, y = next(prefetcher)
+        chex.assert_shape(X, (8, 1))
+        eX, ey = dataiter.next_n(2)
+        chex.assert_trees_all_close((X, y), (eX[0], ey[0]))
+        chex.assert_trees_all_close(next(prefetcher), (eX[1], ey[1]))
+
+    def test_DeviceDataIter(self):
+        dataset = ymir.mp.datasets.Dataset(self.X, self.y, np.full(len(self.X), True), device=True)
+        dataiter = dataset.get_iter("train", 8, idx=np.arange(20))
+        self.assertIsInstance(dataiter, ymir.mp.datasets.DeviceDataIter)
+        self.assertEqual(dataiter.length, 20)
+        X, y = next(dataiter)
+        chex.assert_shape(X, (8, 1))
+        X, y = dataiter.next_n(3)
+        chex.assert_shape(X, (3, 8, 1))
+        for bX in X:
+            self.assertLen(np.unique(bX), 8)
+            self.assertTrue(np.isin(bX, self.X[:20].astype(np.float32)).all())
+        self.assertIsInstance(dataset.get_iter("train", 8, map=lambda X, y: (X, y)), ymir.mp.datasets.DataIter)
+
+    def test_sample(self):
+        # Small batches are drawn without a permutation of the indices, only from the first length of them
+        idx = np.concatenate((np.arange(30), np.full(20, 49)))
+        X, _ = ymir.mp.datasets.sample(jax.random.PRNGKey(0), self.X, self.y, idx, 30, 4, 3000)
+        chex.assert_shape(X, (3000, 4, 1))
+        for bX in X[:100]:
+            self.assertLen(np.unique(bX), 4)
+        _, counts = np.unique(np.asarray(X).reshape(-1), return_counts=True)
+        self.assertLen(counts, 30)
+        self.assertTrue(np.all(np.abs(counts / (3000 * 4 / 30) - 1) < 0.2))
+
     def test_Dataset(self):
         dataset = ymir.mp.datasets.Dataset(self.X, self.y, np.concatenate((np.full(int(len(self.X) * 0.5), True), np.full(int(len(self.X) * 0.5), False))))
         chex.assert_trees_all_close(dataset.X, self.X)
@@ -32,6 +101,49 @@ class TestDatasets(absltest.TestCase):
         X, y = dataset.test()
         chex.assert_trees_all_close(X, self.X[int(len(self.X) * 0.5):])
         chex.assert_trees_all_close(y, self.y[int(len(self.X) * 0.5):])
+        X = self.rng.integers(0, 256, size=(50, 2), dtype=np.uint8)
+        dataset = ymir.mp.datasets.Dataset(X, self.y, np.arange(50) < 25, scale=1 / 255, offset=0.0)
+        for (sX, _), expected in [(dataset.train(), X[:25]), (dataset.test(), X[25:])]:
+            chex.assert_type(sX, np.float32)
+            chex.assert_trees_all_close(sX, expected.astype(np.float32) / 255)
+
+    def test_get_iter(self):
+        dataset = ymir.mp.datasets.Dataset(self.X, self.y, np.concatenate((np.full(int(len(self.X) * 0.5), True), np.full(int(len(self.X) * 0.5), False))))
+        dataiter = dataset.get_iter("test", 4, idx=np.arange(10), filter=lambda y: y == 1, map=lambda X, y: (X * 0, y))
+        self.assertIs(dataiter.X, dataset.X)
+        chex.assert_trees_all_close(dataiter.idx, np.arange(25, 35)[self.y[25:35] == 1])
+        X, y = next(dataiter)
+        chex.assert_shape(X, (dataiter.batch_size, 1))
+        chex.assert_trees_all_close(X, np.zeros_like(X))
+        chex.assert_trees_all_close(y, np.ones_like(y))
+        chex.assert_trees_all_close(dataset.X, self.X)
+
+    def test_fed_split(self):
+        dataset = ymir.mp.datasets.Dataset(self.X, self.y, np.full(len(self.X), True))
+        data = dataset.fed_split([8, 8], ymir.mp.distributions.iid_partition, rng=self.rng)
+        self.assertLen(data, 2)
+        for d in data:
+            self.assertIs(d.X, dataset.X)
+        self.assertEmpty(np.intersect1d(data[0].idx, data[1].idx))
+
+    def test_load(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        np.savez_compressed(f"{dir}/test.npz", X=self.X, y=self.y, train=np.arange(len(self.y)) < 25)
+        for mmap in [True, False]:
+            dataset = ymir.mp.datasets.load("test", dir, mmap=mmap)
+            self.assertEqual(isinstance(dataset.X, np.memmap), mmap)
+            chex.assert_trees_all_close(np.asarray(dataset.X), self.X)
+            chex.assert_trees_all_close(np.asarray(dataset.y), self.y)
+            self.assertEqual(dataset.train_idx.sum(), 25)
+        # Datasets stored only as a directory of arrays are read into memory when not memory-mapped
+        os.remove(f"{dir}/test.npz")
+        dataset = ymir.mp.datasets.load("test", dir, mmap=False)
+        self.assertNotIsInstance(dataset.X, np.memmap)
+        chex.assert_trees_all_close(dataset.X, self.X)
+        os.remove(f"{dir}/test/X.npy")
+        with self.assertRaisesRegex(FileNotFoundError, "X.npy"):
+            ymir.mp.datasets.load("test", dir, mmap=False)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,8 @@
+import os
+import shutil
+import tempfile
+from functools import partial
+
 from absl.testing import absltest
 from absl.testing import parameterized
 
@@ -7,6 +12,14 @@ import numpy as np
 import ymir
 
 
+_CALLS = []
+
+
+def _counted_lda(*args, **kwargs):
+    _CALLS.append(None)
+    return ymir.mp.distributions.lda(*args, **kwargs)
+
+
 class TestDistributions(parameterized.TestCase):
     def setUp(self):
         self.rng = np.random.default_rng(0)
@@ -67,6 +80,42 @@ class TestDistributions(parameterized.TestCase):
         for i, d in enumerate(dist):
             chex.assert_trees_all_close(np.unique(self.y[d]), i)
 
+    def test_Partition(self):
+        dist = ymir.mp.distributions.Partition(np.arange(5), np.array([[0, 2], [2, 5], [0, 5]]))
+        self.assertEqual(len(dist), 3)
+        chex.assert_trees_all_close(dist[1], np.arange(2, 5))
+        chex.assert_trees_all_close(list(dist), [np.arange(2), np.arange(2, 5), np.arange(5)])
+        masks = ymir.mp.distributions.as_partition([self.y == 0, self.y == 1])
+        chex.assert_trees_all_close(list(masks), [np.flatnonzero(self.y == 0), np.flatnonzero(self.y == 1)])
+
+    def test_cache(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        _CALLS.clear()
+        cached = ymir.mp.distributions.cache(partial(_counted_lda, alpha=0.1), dir=dir)
+        dist = cached(self.X, self.y, 3, 2, np.random.default_rng(1))
+        rng = np.random.default_rng(1)
+        cached_dist = cached(self.X, self.y, 3, 2, rng)
+        self.assertLen(_CALLS, 1)
+        chex.assert_trees_all_close(list(cached_dist), list(dist))
+        expected_rng = np.random.default_rng(1)
+        ymir.mp.distributions.lda(self.X, self.y, 3, 2, expected_rng, alpha=0.1)
+        self.assertEqual(rng.random(), expected_rng.random())
+        cached(self.X, self.y, 4, 2, np.random.default_rng(1))
+        self.assertLen(_CALLS, 2)
+
+    def test_cache_local(self):
+        dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dir)
+        # Distinct local functions share a name, so they are never cached where one could load the other's partitions
+        for mapping in [lambda *args: _counted_lda(*args, alpha=0.1), lambda *args: _counted_lda(*args, alpha=10)]:
+            _CALLS.clear()
+            cached = ymir.mp.distributions.cache(mapping, dir=dir)
+            for _ in range(2):
+                dist = cached(self.X, self.y, 3, 2, np.random.default_rng(1))
+            self.assertLen(_CALLS, 2)
+            chex.assert_trees_all_close(list(dist), list(mapping(self.X, self.y, 3, 2, np.random.default_rng(1))))
+        self.assertEmpty(os.listdir(dir))
 
 if __name__ == '__main__':
     absltest.main()
\ No newline at end of file
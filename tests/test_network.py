@@ -1,7 +1,33 @@
 from absl.testing import absltest
 
+import chex
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+
 import ymir
 
+
+def _network(vectorize, stacked=False, device=False, nclients=3, epochs=2, delta=False, batch_size=None):
+    rng = np.random.default_rng(0)
+    X = rng.random((20, 2)).astype(np.float32)
+    y = (X.sum(axis=1) > 1).astype(np.int8)
+    dataset = ymir.mp.datasets.Dataset(X, y, np.full(len(y), True), device=device)
+    opt = optax.sgd(0.1)
+    params = {'w': jnp.zeros((2, 2)), 'b': jnp.zeros(2)}
+    loss = ymir.mp.losses.cross_entropy_loss(_Linear(), 2)
+    network = ymir.mp.network.Network(vectorize=vectorize, stacked=stacked, delta=delta)
+    network.add_controller("main", server=True)
+    for d in dataset.fed_split([batch_size for _ in range(nclients)], rng=rng):
+        network.add_host("main", ymir.regiment.Scout(opt, opt.init(params), loss, d, epochs))
+    return network, params
+
+
+class _Linear:
+    def apply(self, params, X):
+        return X @ params['w'] + params['b']
+
 class TestNetwork(absltest.TestCase):
     def test_controller(self):
         controller = ymir.mp.network.Controller(0.1)
@@ -9,6 +35,7 @@ class TestNetwork(absltest.TestCase):
         self.assertListEqual(controller.switches, [])
         self.assertEqual(controller.C, 0.1)
         self.assertEqual(controller.K, 0)
+        self.assertFalse(controller.vectorize)
 
     def test_network(self):
         network = ymir.mp.network.Network(0.1)
@@ -17,6 +44,82 @@ class TestNetwork(absltest.TestCase):
         self.assertEqual(network.server_name, "")
         self.assertEqual(network.C, 0.1)
 
+    def test_vectorized_update(self):
+        network, params = _network(False, batch_size=2)
+        vnetwork, _ = _network(True, batch_size=2)
+        all_grads = network(params, np.random.default_rng(0))
+        vall_grads = vnetwork(params, np.random.default_rng(0))
+        self.assertEqual(len(all_grads), len(vall_grads))
+        for g, vg in zip(all_grads, vall_grads):
+            chex.assert_trees_all_close(g, vg, rtol=1e-5)
+        all_weights = vnetwork(params, np.random.default_rng(0), return_weights=True)
+        chex.assert_trees_all_equal_shapes(all_weights[0], params)
+
+    def test_prefetch(self):
+        all_updates = []
+        for _ in range(2):
+            pnetwork, params = _network(False, batch_size=2)
+            pnetwork.prefetch()
+            for c in pnetwork.clients:
+                self.assertIsInstance(c.data, ymir.mp.datasets.Prefetcher)
+            self.assertIsNot(pnetwork.clients[0].data.rng, pnetwork.clients[1].data.rng)
+            rng = np.random.default_rng(0)
+            all_updates.append([pnetwork(params, rng) for _ in range(3)])
+        for updates, pupdates in zip(*all_updates):
+            for g, pg in zip(updates, pupdates):
+                chex.assert_trees_all_close(g, pg, rtol=1e-5)
+
+    def test_device_update(self):
+        network, params = _network(False)
+        all_grads = network(params, np.random.default_rng(0))
+        for vectorize in [False, True]:
+            dnetwork, _ = _network(vectorize, device=True)
+            for c in dnetwork.clients:
+                self.assertIsInstance(c.data, ymir.mp.datasets.DeviceDataIter)
+            for g, dg in zip(all_grads, dnetwork(params, np.random.default_rng(0))):
+                chex.assert_trees_all_close(g, dg, rtol=1e-5)
+        # With batches smaller than the client data, the device sampling must match between the two update paths
+        dnetwork, _ = _network(False, device=True, nclients=4, batch_size=2)
+        vnetwork, _ = _network(True, device=True, nclients=4, batch_size=2)
+        for g, vg in zip(dnetwork(params, np.random.default_rng(0)), vnetwork(params, np.random.default_rng(0))):
+            chex.assert_trees_all_close(g, vg, rtol=1e-5)
+
+    def test_stacked_update(self):
+        network, params = _network(False)
+        all_grads = network(params, np.random.default_rng(0))
+        for vectorize in [False, True]:
+            snetwork, _ = _network(vectorize, stacked=True)
+            sall_grads = snetwork(params, np.random.default_rng(0))
+            self.assertIsInstance(sall_grads, ymir.mp.updates.UpdateMatrix)
+            chex.assert_shape(sall_grads.G, (len(all_grads), 6))
+            for g, sg in zip(all_grads, sall_grads):
+                chex.assert_trees_all_close(g, sg, rtol=1e-5)
+
+    def test_delta_update(self):
+        network, params = _network(False)
+        params = jax.tree_map(lambda x: x + 0.5, params)
+        all_weights = network(params, np.random.default_rng(0), return_weights=True)
+        for vectorize, stacked in [(False, False), (True, False), (False, True), (True, True)]:
+            dnetwork, _ = _network(vectorize, stacked=stacked, delta=True)
+            all_deltas = dnetwork(params, np.random.default_rng(0), return_weights=True)
+            self.assertEqual(len(all_deltas), len(all_weights))
+            for w, d in zip(all_weights, all_deltas):
+                chex.assert_trees_all_close(w, jax.tree_map(jnp.add, d, params), rtol=1e-5, atol=1e-6)
+
+    def test_participation_ids(self):
+        base, params = _network(False, nclients=6)
+        for stacked in [False, True]:
+            network = ymir.mp.network.Network(0.5, stacked=stacked)
+            network.add_controller("main", server=True)
+            network.add_controller("sub")
+            network.connect_controllers("main", "sub")
+            for i, c in enumerate(base.clients):
+                network.add_host("main" if i < 3 else "sub", c)
+            all_grads = network(params, np.random.default_rng(0))
+            ids = ymir.mp.updates.get_ids(all_grads)
+            self.assertLen(all_grads, 2)
+            self.assertIn(ids[0], [3, 4, 5])
+            self.assertIn(ids[1], [0, 1, 2])
 
 if __name__ == '__main__':
     absltest.main()
\ No newline at end of file
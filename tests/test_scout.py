@@ -1,11 +1,15 @@
+from functools import partial
+
 from absl.testing import absltest
 
+import chex
 import optax
 import haiku as hk
 import jax
 import numpy as np
 
 import ymir
+import ymirlib
 
 class TestScoutFunctions(absltest.TestCase):
     def setUp(self):
@@ -13,9 +17,10 @@ class TestScoutFunctions(absltest.TestCase):
         dataset = ymir.mp.datasets.Dataset((X := rng.random((50, 1))), np.sin(X).reshape(-1), np.full(len(X), True))
         self.data = dataset.get_iter("train")
         net = hk.without_apply_rng(hk.transform(lambda x: ymir.mp.models.LeNet_300_100(dataset.classes, x)))
-        params = net.init(jax.random.PRNGKey(42), next(self.data)[0])
-        opt = optax.sgd(0.1)
-        self.opt_state = opt.init(params)
+        self.params = net.init(jax.random.PRNGKey(42), next(self.data)[0])
+        self.loss = ymir.mp.losses.cross_entropy_loss(net, dataset.classes)
+        self.opt = optax.sgd(0.1)
+        self.opt_state = self.opt.init(self.params)
         self.client = ymir.regiment.Scout(None, self.opt_state, None, self.data, 1)
 
     def test_member_variables(self):
@@ -25,6 +30,36 @@ class TestScoutFunctions(absltest.TestCase):
         self.assertEqual(self.client.epochs, 1)
         self.assertTrue(callable(self.client.update))
 
+    def test_is_standard(self):
+        client = ymir.regiment.Scout(self.opt, self.opt_state, self.loss, self.data, 1)
+        self.assertTrue(ymir.regiment.scout.is_standard(client))
+        # An update rebound to another loss function must not be fused with the client's own
+        client.update = partial(ymir.regiment.scout.update, self.opt, lambda params, X, y: -self.loss(params, X, y))
+        self.assertFalse(ymir.regiment.scout.is_standard(client))
+        client.update = lambda params, opt_state, X, y: ymir.regiment.scout.update(
+            self.opt, self.loss, params, opt_state, X, y
+        )
+        self.assertFalse(ymir.regiment.scout.is_standard(client))
+
+    def test_train(self):
+        batches = [next(self.data) for _ in range(3)]
+        params, opt_state, sum_grads = self.params, self.opt_state, None
+        for X, y in batches:
+            grads, opt_state, updates = ymir.regiment.scout.update(self.opt, self.loss, params, opt_state, X, y)
+            params = optax.apply_updates(params, updates)
+            sum_grads = grads if sum_grads is None else ymirlib.tree_add(sum_grads, grads)
+        X, y = (np.stack(b) for b in zip(*batches))
+        train_grads, _, train_params = ymir.regiment.scout.train(self.opt, self.loss, self.params, self.opt_state, X, y)
+        chex.assert_trees_all_close(train_grads, sum_grads, rtol=1e-5, atol=1e-6)
+        chex.assert_trees_all_close(train_params, params, rtol=1e-5, atol=1e-6)
+        # Integer typed samples are normalized within the fused training
+        X = np.random.default_rng(1).integers(0, 256, size=(3, 50, 1), dtype=np.uint8)
+        chex.assert_trees_all_close(
+            ymir.regiment.scout.train(self.opt, self.loss, self.params, self.opt_state, X, y, 1 / 255, 0.0),
+            ymir.regiment.scout.train(self.opt, self.loss, self.params, self.opt_state, X / np.float32(255), y),
+            rtol=1e-5, atol=1e-6
+        )
+
 
 if __name__ == '__main__':
     absltest.main()
\ No newline at end of file
@@ -0,0 +1,79 @@
+from absl.testing import absltest
+
+import chex
+import jax
+import jax.numpy as jnp
+
+import ymir
+import ymirlib
+
+
+@chex.dataclass
+class Params:
+    w: chex.ArrayDevice
+    b: chex.ArrayDevice
+
+
+class TestUpdates(absltest.TestCase):
+    def setUp(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), 5)
+        self.all_grads = [
+            Params(w=jax.random.uniform(r, (10,), dtype=jnp.float32), b=jax.random.uniform(r, (2,), dtype=jnp.float32))
+            for r in rngs
+        ]
+
+    def test_as_matrix(self):
+        matrix = ymir.mp.updates.as_matrix(self.all_grads)
+        chex.assert_shape(matrix.G, (5, 12))
+        self.assertEqual(len(matrix), 5)
+        self.assertIs(ymir.mp.updates.as_matrix(matrix), matrix)
+        for g, m in zip(self.all_grads, matrix):
+            chex.assert_trees_all_close(g, m)
+        chex.assert_trees_all_close(matrix[1:3], self.all_grads[1:3])
+
+    def test_setitem(self):
+        matrix = ymir.mp.updates.as_matrix(self.all_grads)
+        matrix[0] = self.all_grads[1]
+        chex.assert_trees_all_close(matrix[0], self.all_grads[1])
+        matrix[-2:] = self.all_grads[:2]
+        chex.assert_trees_all_close(matrix[-2:], self.all_grads[:2])
+
+    def test_aggregation(self):
+        matrix = ymir.mp.updates.as_matrix(self.all_grads)
+        alpha = jnp.arange(5, dtype=jnp.float32)
+        scaled = [ymirlib.tree_mul(g, a) for g, a in zip(self.all_grads, alpha)]
+        chex.assert_trees_all_close(matrix.scale(alpha)[2], scaled[2])
+        chex.assert_trees_all_close(matrix.sum(), ymirlib.tree_add(*self.all_grads), rtol=1e-5)
+        chex.assert_trees_all_close(matrix.weighted_sum(alpha), ymirlib.tree_add(*scaled), rtol=1e-5)
+
+    def test_reductions(self):
+        matrix = ymir.mp.updates.as_matrix(self.all_grads)
+        origin = self.all_grads[0]
+        for a, b in [
+            (ymir.mp.updates.norms(self.all_grads), ymir.mp.updates.norms(matrix)),
+            (ymir.mp.updates.norms(self.all_grads, origin), ymir.mp.updates.norms(matrix, origin)),
+            (ymir.mp.updates.gram(self.all_grads), ymir.mp.updates.gram(matrix)),
+        ]:
+            chex.assert_trees_all_close(a, b, rtol=1e-5, atol=1e-6)
+        alpha = jnp.linspace(0, 1, 5)
+        chex.assert_trees_all_close(
+            ymir.mp.updates.weighted_sum(self.all_grads, alpha), ymir.mp.updates.weighted_sum(matrix, alpha), rtol=1e-5
+        )
+
+    def test_offset_reductions(self):
+        offset = jax.tree_map(lambda x: x + 1, self.all_grads[0])
+        offset_grads = [jax.tree_map(jnp.add, g, offset) for g in self.all_grads]
+        alpha = jnp.linspace(0, 1, 5)
+        for all_grads in [self.all_grads, ymir.mp.updates.as_matrix(self.all_grads)]:
+            chex.assert_trees_all_close(
+                ymir.mp.updates.gram(all_grads, offset=offset), ymir.mp.updates.gram(offset_grads), rtol=1e-5
+            )
+            chex.assert_trees_all_close(
+                ymir.mp.updates.weighted_sum(all_grads, alpha, offset=offset),
+                ymir.mp.updates.weighted_sum(offset_grads, alpha),
+                rtol=1e-5
+            )
+
+
+if __name__ == '__main__':
+    absltest.main()
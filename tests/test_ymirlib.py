@@ -90,6 +90,58 @@ class TestTreeFunctions(parameterized.TestCase):
         chex.assert_tree_no_nones(add_params)
         chex.assert_tree_all_close(add_params, Params(w=jnp.full(self.length, a + b), b=jnp.full(self.length, a + b)))
 
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{n=}", "n": n}
+            for n in [1, 2, 5]
+        ]
+    )
+    def test_tree_stack(self, n):
+        trees = [Params(w=jnp.full(self.length, i), b=jnp.full(self.length, -i)) for i in range(n)]
+        stacked = ymirlib.tree_stack(trees)
+        chex.assert_shape(stacked.w, (n, self.length))
+        for tree, unstacked in zip(trees, ymirlib.tree_unstack(stacked)):
+            chex.assert_trees_all_close(tree, unstacked)
+
+    @parameterized.named_parameters(
+        [
+            {"testcase_name": f"_{block_size=}", "block_size": block_size}
+            for block_size in [None, 1, 3, 16]
+        ]
+    )
+    def test_cosine_similarity(self, block_size):
+        X = jax.random.normal(jax.random.PRNGKey(0), (7, 5)).at[2].set(0)
+        norms = jnp.linalg.norm(X, axis=1, keepdims=True)
+        Xn = X / jnp.where(norms == 0, 1, norms)
+        cs = ymirlib.cosine_similarity(X, block_size)
+        chex.assert_type(cs, jnp.float32)
+        chex.assert_trees_all_close(cs, Xn @ Xn.T, atol=1e-6)
+        chex.assert_trees_all_close(ymirlib.gram(X, block_size), X @ X.T, atol=1e-5)
+
+    def test_gram_update_rows(self):
+        X = jax.random.normal(jax.random.PRNGKey(0), (6, 4))
+        K = ymirlib.gram(X)
+        ids = jnp.array([4, 1])
+        X = X.at[ids].add(jax.random.normal(jax.random.PRNGKey(1), (2, 4)))
+        chex.assert_trees_all_close(ymirlib.gram_update_rows(K, X, ids), X @ X.T, atol=1e-5)
+
+    def test_tree_reductions(self):
+        rngs = jax.random.split(jax.random.PRNGKey(0), 4)
+        trees = [Params(w=jax.random.normal(r, (3, 2)), b=jax.random.normal(r, (4,))) for r in rngs]
+        G = jnp.stack([ymirlib.tree_flatten(t) for t in trees])
+        chex.assert_trees_all_close(ymirlib.tree_norms(trees), jnp.linalg.norm(G, axis=1), rtol=1e-5)
+        chex.assert_trees_all_close(
+            ymirlib.tree_norms(trees, trees[0]), jnp.linalg.norm(G - G[0], axis=1), rtol=1e-5, atol=1e-6
+        )
+        for block_size in [None, 3]:
+            chex.assert_trees_all_close(ymirlib.tree_gram(trees, block_size), G @ G.T, rtol=1e-5, atol=1e-5)
+        alpha = jnp.array([0.5, 0.0, 1.0, 2.0])
+        chex.assert_trees_all_close(ymirlib.tree_flatten(ymirlib.tree_weighted_sum(trees, alpha)), alpha @ G, rtol=1e-5)
+        # The leaves are only stacked as they are reached
+        leaves = ymirlib.tree_stack_leaves(trees)
+        for leaf in jax.tree_leaves(trees[0]):
+            chex.assert_shape(next(leaves), (len(trees), leaf.size))
+
 
 if __name__ == '__main__':
     absltest.main()
\ No newline at end of file
@@ -7,11 +7,15 @@ import optax
 
 import ymirlib
 
+from . import bulyan
 from . import contra
 from . import fedavg
 from . import flguard
 from . import foolsgold
+from . import history
 from . import krum
+from . import median
 from . import norm_clipping
 from . import std_dagmm
+from . import trimmed_mean
 from . import viceroy
\ No newline at end of file
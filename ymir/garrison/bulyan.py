@@ -0,0 +1,97 @@
+"""
+The Bulyan algorithm proposed in `https://arxiv.org/abs/1802.07927 <https://arxiv.org/abs/1802.07927>`_
+it is designed to be robust to Byzantine faults by combining a recursive Krum selection with a coordinate-wise trimmed mean.
+"""
+
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+import ymirlib
+from ymir.mp import updates
+
+from . import trimmed_mean
+
+
+class Captain(trimmed_mean.Captain):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), clip=3, block_size=256):
+        """
+        Construct the Bulyan captain.
+
+        Optional arguments:
+        - clip: the number of expected faults in each round.
+        - block_size: the number of coordinates to aggregate at a time.
+        """
+        super().__init__(params, opt, opt_state, network, rng, clip=clip, block_size=block_size)
+
+    def aggregate(self, all_grads):
+        matrix = updates.as_matrix(all_grads)
+        g, alpha = bulyan(matrix.G, self.clip, self.block_size)
+        return alpha, matrix.unraveller(g)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def bulyan(G, clip, block_size=256):
+    r"""
+    Find the Bulyan aggregate of the updates. First $\theta = n - 2f$ clients are selected by recursively applying Krum,
+    then each coordinate is found as the mean of the $\beta = \theta - 2f$ values of the selected clients closest to
+    their median. This requires $n \geq 4f + 3$ clients.
+
+    Arguments:
+    - G: the matrix of flattened updates, one row per client
+    - clip: the number of expected faults, $f$
+    - block_size: the number of coordinates to aggregate at a time, and of rows of the Gram matrix to find at a time
+
+    Returns the aggregate of each of the coordinates, and the share of the aggregate from each of the clients.
+    """
+    n = G.shape[0]
+    if n < 4 * clip + 3:
+        raise ValueError(f"Bulyan requires at least 4f + 3 = {4 * clip + 3} clients, got {n}")
+    theta = n - 2 * clip
+    beta = theta - 2 * clip
+    selected = recursive_krum(ymirlib.gram(G, block_size), clip, theta)
+    return trimmed_mean.coordinatewise(
+        partial(closest_weights, selected=selected, theta=theta, beta=beta), G, block_size
+    )
+
+
+def recursive_krum(K, clip, theta):
+    """
+    Select theta clients by repeatedly applying Krum to the clients not yet selected and selecting its choice, where
+    each of the r remaining clients is scored by the squared distances to its r - f - 2 nearest remaining neighbours.
+    This is intended to be traced within a jitted aggregator.
+
+    Arguments:
+    - K: the Gram matrix of the updates
+    - clip: the number of expected faults, $f$
+    - theta: the number of clients to select
+
+    Returns the mask of the selected clients.
+    """
+    n = K.shape[0]
+    sq_norms = jnp.diag(K)
+    D = jnp.maximum(sq_norms[:, None] + sq_norms[None] - 2 * K, 0)
+    D = jnp.where(jnp.eye(n, dtype=bool), jnp.inf, D)
+
+    def select(i, selected):
+        remaining = n - i
+        # As too few clients remain towards the end of the selection, at least one neighbour is scored where possible
+        k = jnp.minimum(jnp.maximum(remaining - clip - 2, 1), remaining - 1)
+        nearest = jnp.sort(jnp.where(selected[None], jnp.inf, D), axis=1)
+        scores = jnp.sum(jnp.where(jnp.arange(n) < k, nearest, 0), axis=1)
+        return selected.at[jnp.argmin(jnp.where(selected, jnp.inf, scores))].set(True)
+
+    return jax.lax.fori_loop(0, theta, select, jnp.zeros(n, dtype=bool))
+
+
+def closest_weights(X, selected, theta, beta):
+    """
+    Weigh the values of each column of X for the mean of the beta values closest to their median among the theta
+    selected clients.
+    """
+    values = jnp.where(selected[:, None], X, jnp.inf)
+    med = (trimmed_mean.order_statistic(values, (theta - 1) // 2) + trimmed_mean.order_statistic(values, theta // 2)) / 2
+    distances = jnp.where(selected[:, None], jnp.abs(X - med), jnp.inf)
+    return trimmed_mean.smallest_weights(distances, beta) / beta
@@ -1,21 +1,29 @@
 """
 There are two generic forms of servers defined here:
 - ScaleCaptain: a server that takes in a collection of gradients and algorithmically scales them
-- AggregateCaptain: a server that takes in a collection of weights and aggregates them into a single weight
+- AggregateCaptain: a server that takes in a collection of weights, or gradients, and aggregates them into a single one
+
+Additionally, a CompiledScaleCaptain is a ScaleCaptain whose scaling is purely arithmetic, allowing whole rounds to be
+compiled into a single program.
 """
 
 
 from abc import ABC, abstractmethod
+from functools import partial
 from typing import Iterable
 import numpy as np
 
 import optax
 import jax
+import jax.numpy as jnp
 import jaxlib
 
 import ymirlib
 
 from ymir.mp.network import Network
+from ymir.mp import datasets
+from ymir.mp import updates
+from ymir.regiment import scout
 
 
 class ScaleCaptain(ABC):
@@ -27,6 +35,7 @@ class ScaleCaptain(ABC):
 
     def __init__(self, params, opt, opt_state, network, rng):
         self.params = params
+        self.opt = opt
         self.opt_state = opt_state
         self.network = network
         self.rng = rng
@@ -60,6 +69,59 @@ class ScaleCaptain(ABC):
         return alpha, all_grads
 
 
+class CompiledScaleCaptain(ScaleCaptain):
+    """
+    A ScaleCaptain whose scale is a pure function of the stacked updates, so that whole rounds, from the training of the
+    selected clients to the update of the global parameters, may be compiled into a single program with `compiled_step`.
+    """
+    @abstractmethod
+    def compiled_scale(self):
+        """
+        Get the jittable form of scale, as a function taking the stacked sums of gradients of the selected clients, their
+        ids, and then the returned arguments, and giving the amount to scale each of the gradients by.
+        """
+        pass
+
+    def compiled_step(self, rounds=1):
+        """
+        Perform rounds of step within a single compiled program, the rounds are run by a scan without returning to
+        Python. The clients are selected by the captain's random number generator as the network would, so the rounds
+        follow the same course as calls to step. Returns the alpha of each round as a matrix with a row per round and a
+        column per client, where the clients that were not selected have an alpha of 0.
+
+        This requires the network to be a single controller without update transforms, holding standard clients that
+        share an optimizer, loss function, batch size, number of epochs, and device resident data.
+
+        Optional arguments:
+        - rounds: the number of rounds to perform
+        """
+        controller = self.network.get_controller(self.network.server_name)
+        clients = controller.clients
+        if controller.switches or controller.update_transform_chain:
+            raise ValueError("Compiled rounds require a single controller without update transforms")
+        if not all(scout.is_standard(c) and isinstance(c.data, datasets.DeviceDataIter) for c in clients):
+            raise ValueError("Compiled rounds require standard clients with device resident data")
+        if len({(c.opt, c.loss, c.batch_size, c.epochs, id(c.data.X)) for c in clients}) > 1:
+            raise ValueError("Compiled rounds require clients that share an optimizer, loss, batch size, epochs, and data")
+        selections = np.stack([
+            self.rng.choice(controller.K, size=int(controller.C * controller.K), replace=False) for _ in range(rounds)
+        ])
+        data = [c.data for c in clients]
+        max_length = max(d.length for d in data)
+        scale, scale_args = self.compiled_scale()
+        self.params, self.opt_state, opt_states, keys, alphas = compiled_rounds(
+            self.opt, clients[0].opt, clients[0].loss, clients[0].batch_size, clients[0].epochs, scale, len(self.network),
+            self.params, self.opt_state, ymirlib.tree_stack([c.opt_state for c in clients]),
+            jnp.stack([d.key for d in data]), data[0].X, data[0].y,
+            jnp.stack([jnp.pad(d.idx, (0, max_length - d.length)) for d in data]), jnp.array([d.length for d in data]),
+            data[0].scale, data[0].offset, jnp.array(controller.ids), jnp.array(selections), scale_args
+        )
+        for c, s, k in zip(clients, ymirlib.tree_unstack(opt_states, len(clients)), keys):
+            c.opt_state = s
+            c.data.key = k
+        return alphas
+
+
 class AggregateCaptain(ABC):
     """A captian that aggregates weights into a single global weight, $w_t$"""
     params: optax.Params
@@ -99,10 +161,61 @@ def update(opt):
     return _apply
 
 
+@partial(jax.jit, static_argnums=(0, 1, 2, 3, 4, 5, 6))
+def compiled_rounds(
+    opt, client_opt, loss, batch_size, epochs, scale, n, params, opt_state, client_opt_states, keys, X, y, idx, length,
+    data_scale, offset, ids, selections, scale_args
+):
+    """
+    Perform a round of federated learning for each of the rows of selections within a single compiled scan, see
+    `CompiledScaleCaptain.compiled_step`. The client optimizer states, sampling keys, and data indices are stacked with
+    a leading axis indexing the clients of the controller.
+
+    Returns the global parameters and optimizer state, the client optimizer states and sampling keys, and the alpha of
+    each round.
+    """
+    def _round(carry, selected):
+        params, opt_state, client_opt_states, keys = carry
+        # Advance the sampling key of each selected client as `ymir.mp.datasets.DeviceDataIter.next_key` does
+        split_keys = jax.vmap(jax.random.split)(keys[selected])
+        keys = keys.at[selected].set(split_keys[:, 0])
+        sum_grads, selected_opt_states, _ = scout.batch_sample_train(
+            client_opt, loss, batch_size, epochs, jax.tree_map(lambda x: jnp.stack([x] * selected.shape[0]), params),
+            jax.tree_map(lambda s: s[selected], client_opt_states), split_keys[:, 1], X, y, idx[selected],
+            length[selected], data_scale, offset
+        )
+        client_opt_states = jax.tree_multimap(lambda s, ss: s.at[selected].set(ss), client_opt_states, selected_opt_states)
+        alpha = scale(sum_grads, ids[selected], *scale_args)
+        grads = jax.tree_map(lambda g: jnp.tensordot(alpha, g, axes=1), sum_grads)
+        param_updates, opt_state = opt.update(grads, opt_state, params)
+        params = optax.apply_updates(params, param_updates)
+        return (params, opt_state, client_opt_states, keys), jnp.zeros(n, alpha.dtype).at[ids[selected]].set(alpha)
+
+    (params, opt_state, client_opt_states, keys), alphas = jax.lax.scan(
+        _round, (params, opt_state, client_opt_states, keys), selections
+    )
+    return params, opt_state, client_opt_states, keys, alphas
+
+
+def get_scale(server, all_grads):
+    """
+    Update a captain with a collection of gradients and find the scale of each of them. Captains that aggregate the
+    gradients rather than scaling them instead give the share of the aggregate from each of the gradients.
+    """
+    if isinstance(server, ScaleCaptain):
+        server.update(all_grads)
+        return server.scale(all_grads)
+    return server.aggregate(all_grads)[0]
+
+
 def apply_scale(alpha, all_grads):
     """Scale a collection of gradients by the value of alpha"""
+    if isinstance(all_grads, updates.UpdateMatrix):
+        return all_grads.scale(alpha)
     return [ymirlib.tree_mul(g, a) for g, a in zip(all_grads, alpha)]
 
 def sum_grads(all_grads):
     """Element-wise sum together a collection of gradients, simplifies boilerplate"""
+    if isinstance(all_grads, updates.UpdateMatrix):
+        return all_grads.sum()
     return ymirlib.tree_add(*all_grads)
\ No newline at end of file
@@ -3,16 +3,22 @@ The CONTRA algorithm proposed in `https://www.ittc.ku.edu/~bluo/pubs/Awan2021ESO
 it is designed to provide robustness to poisoning adversaries within many statistically heterogenous environments.
 """
 
+from functools import partial
+
 import numpy as np
-import sklearn.metrics.pairwise as smp
 import jax
 import jax.numpy as jnp
 
+from ymir.mp import updates
+
 from . import captain
+from . import history
 
 
 class Captain(captain.ScaleCaptain):
-    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), C=0.1, k=10, delta=0.1, t=0.5):
+    def __init__(
+        self, params, opt, opt_state, network, rng=np.random.default_rng(), C=0.1, k=10, delta=0.1, t=0.5, sketch=None, memmap=None
+    ):
         """
         Construct the CONTRA captain.
 
@@ -22,46 +28,62 @@ class Captain(captain.ScaleCaptain):
         - k: Number of expected adversarial collaborators.
         - delta: Amount the increase/decrease the reputation (selection likelyhood) by.
         - t: Threshold for choosing when to increase the reputation.
+        - sketch: if specified, sketch the histories to this many dimensions, see `history.History`.
+        - memmap: if specified, hold the histories on disk, True for a temporary file or a file path, see `history.create`.
         """
         super().__init__(params, opt, opt_state, network, rng)
-        self.histories = jnp.zeros((len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0]))
+        self.histories = history.create(
+            len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0], gram=True, sketch=sketch, memmap=memmap
+        )
         self.C = C
         self.k = round(k * C)
         self.lamb = C * (1 - C)
         self.delta = delta
         self.t = t
-        self.reps = np.ones(len(network))
-        self.J = round(self.C * len(network))
+        self.reps = jnp.ones(len(network), dtype=jnp.float32)
 
     def update(self, all_grads):
         """Update the stored collaborator histories, that is, perform $H_{i, t + 1} \gets H_{i, t} + \Delta_{i, t + 1} : \\forall i \in \mathcal{U}$"""
-        self.histories = update(self.histories, all_grads)
+        self.histories.update(all_grads, updates.get_ids(all_grads))
 
     def scale(self, all_grads):
-        n_clients = self.histories.shape[0]
-        p = self.C + self.lamb * self.reps
-        p[p == 0] = 0
-        p = p / p.sum()
-        idx = np.random.choice(n_clients, size=self.J, p=p)
-        L = idx.shape[0]
-        cs = abs(smp.cosine_similarity(self.histories[idx])) - np.eye(L)
-        cs[cs < 0] = 0
-        taus = (-np.partition(-cs, self.k - 1, axis=1)[:, :self.k]).mean(axis=1)
-        self.reps[idx] = np.where(taus > self.t, self.reps[idx] + self.delta, self.reps[idx] - self.delta)
-        cs = cs * np.minimum(1, taus[:, None] / taus)
-        taus = (-np.partition(-cs, self.k - 1, axis=1)[:, :self.k]).mean(axis=1)
-        lr = np.zeros(n_clients)
-        lr[idx] = 1 - taus
-        self.reps[idx] = self.reps[idx] / self.reps[idx].max()
-        lr[idx] = lr[idx] / lr[idx].max()
-        lr[(lr == 1)] = .99  # eliminate division by zero in logit
-        lr[idx] = np.log(lr[idx] / (1 - lr[idx])) + 0.5
-        lr[(np.isinf(lr) + lr > 1)] = 1
-        lr[(lr < 0)] = 0
+        ids = updates.get_ids(all_grads)
+        ids = np.arange(len(self.histories)) if ids is None else np.asarray(ids)
+        n_clients = ids.shape[0]
+        p = np.asarray(self.C + self.lamb * self.reps[ids], dtype=np.float64)
+        idx = self.rng.choice(n_clients, size=max(1, round(self.C * n_clients)), p=p / p.sum())
+        lr, reps = score(
+            self.histories.similarity(ids[idx]), idx, self.reps[ids], min(max(self.k, 1), len(idx)), self.t, self.delta
+        )
+        self.reps = self.reps.at[ids].set(reps)
         return lr
 
 
-@jax.jit
-def update(histories, all_grads):
-    """Perform histories + all_grads, elementwise."""
-    return jnp.array([h + jax.flatten_util.ravel_pytree(g)[0] for h, g in zip(histories, all_grads)])
\ No newline at end of file
+@partial(jax.jit, static_argnums=(3,))
+def score(cs, idx, reps, k, t, delta):
+    """
+    Find the learning rates of the participating clients and update their reputations from the similarities of the
+    histories of the sampled clients.
+
+    Arguments:
+    - cs: the pairwise cosine similarities of the histories of the sampled clients
+    - idx: the indices of the sampled clients among the participating clients
+    - reps: the reputations of the participating clients
+    - k: the number of most similar clients that each sampled client is compared to
+    - t: the threshold on the mean similarity above which the reputation of a client is increased
+    - delta: the amount to change the reputations by
+
+    Returns the learning rates and the updated reputations of the participating clients.
+    """
+    cs = jnp.maximum(jnp.abs(cs) - jnp.eye(cs.shape[0], dtype=cs.dtype), 0)
+    taus = jnp.mean(jax.lax.top_k(cs, k)[0], axis=1)
+    sampled_reps = jnp.where(taus > t, reps[idx] + delta, reps[idx] - delta)
+    reps = reps.at[idx].set(sampled_reps / sampled_reps.max())
+    # Clients with no similar clients have a column of zeros, so are left unweighted
+    cs = cs * jnp.minimum(1, taus[:, None] / jnp.where(taus > 0, taus, 1))
+    lr = 1 - jnp.mean(jax.lax.top_k(cs, k)[0], axis=1)
+    lr = lr / jnp.maximum(lr.max(), jnp.finfo(lr.dtype).tiny)  # all 0 when every selected client agrees
+    lr = jnp.where(lr == 1, .99, lr)  # eliminate division by zero in logit
+    lr = jnp.log(lr / (1 - lr)) + 0.5
+    lr = jnp.clip(lr, 0, 1)
+    return jnp.zeros(reps.shape[0], dtype=jnp.float32).at[idx].set(lr), reps
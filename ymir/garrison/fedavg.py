@@ -8,10 +8,12 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 
+from ymir.mp import updates
+
 from . import captain
 
 
-class Captain(captain.ScaleCaptain):
+class Captain(captain.CompiledScaleCaptain):
     def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng()):
         super().__init__(params, opt, opt_state, network, rng)
         self.batch_sizes = jnp.array([c.batch_size * c.epochs for c in network.clients])
@@ -21,4 +23,15 @@ class Captain(captain.ScaleCaptain):
         self.batch_sizes = jnp.array([c.batch_size * c.epochs for c in self.network.clients])
 
     def scale(self, all_grads):
-        return jax.vmap(lambda b: b / self.batch_sizes.sum())(self.batch_sizes)
\ No newline at end of file
+        ids = updates.get_ids(all_grads)
+        return scale(None, jnp.arange(len(self.batch_sizes)) if ids is None else jnp.asarray(ids), self.batch_sizes)
+
+    def compiled_scale(self):
+        self.update(None)
+        return scale, (self.batch_sizes,)
+
+
+@jax.jit
+def scale(all_grads, ids, batch_sizes):
+    """Scale the stacked gradients of the clients with the ids by their share of the total batch size of those clients"""
+    return batch_sizes[ids] / batch_sizes[ids].sum()
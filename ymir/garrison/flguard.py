@@ -4,40 +4,49 @@ it is designed to provide robustness against adversaries, inclusive of multiple
 heterogeneity environments.
 """
 
+from functools import partial
+
 import numpy as np
-import sklearn.metrics.pairwise as smp
 import jax
 import jax.flatten_util
+import jax.numpy as jnp
 import hdbscan
 
+import ymirlib
+from ymir.mp import updates
+
 from . import captain
 
 
 class Captain(captain.AggregateCaptain):
-    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), lamb=0.001):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), lamb=0.001, clustering="hdbscan"):
         """
         Construct the FLGuard captain.
 
         Optional arguments:
         - lamb: the lambda parameter for the FLGuard algorithm, scales the noise added to the global weight.
+        - clustering: the clustering backend used to find the majority cluster, either "hdbscan", "mst" for the exact
+          single-linkage clustering of `mst_cluster`, or a function taking the matrix of cosine distances and the
+          minimum cluster size and returning the cluster label of each client, with -1 for noise
         """
         super().__init__(params, opt, opt_state, network, rng)
         self.G_unraveller = jax.flatten_util.ravel_pytree(params)[1]
         self.lamb = lamb  # 0.001 is good for image classification, 0.01 for IDS (according to the paper)
+        self.cluster = {"hdbscan": hdbscan_cluster, "mst": mst_cluster}.get(clustering, clustering)
 
     def update(self, all_weights):
-        G = np.array(jax.flatten_util.ravel_pytree(self.params)[0])
-        Ws = np.array([jax.flatten_util.ravel_pytree(w)[0] for w in all_weights])
-        n_clients = Ws.shape[0]
-        cs = smp.cosine_distances(Ws).astype(np.double)
-        clusters = hdbscan.HDBSCAN(min_cluster_size=n_clients // 2 + 1, metric='precomputed', allow_single_cluster=True).fit_predict(cs)
-        bs = np.arange(len(clusters))[clusters == np.argmax(np.bincount(clusters[clusters != -1]))]
-        es = np.linalg.norm(G - Ws, axis=1)  # Euclidean distance between G and each Ws
-        S = np.median(es)
-        Ws[bs] = (Ws[bs].T * np.minimum(1, S / es[bs])).T
-        G = Ws[bs].mean(axis=0)
-        sigma = self.lamb / S
-        G = G + self.rng.normal(0, sigma, G.shape)
+        n_clients = len(all_weights)
+        # With a delta transport the updates are $W_i - G$, and the weights are only reconstructed within the reductions
+        offset = self.params if self.network.delta else None
+        labels = jnp.asarray(self.cluster(distances(updates.gram(all_weights, offset=offset)), n_clients // 2 + 1))
+        if not jnp.any(labels >= 0):
+            # Without a majority cluster no update can be trusted, so the global model is kept as it is
+            return self.params
+        es = updates.norms(all_weights, None if self.network.delta else self.params)  # Euclidean distance between G and each Ws
+        # Clip the weights of the majority cluster and find their mean as a weighted sum
+        alpha, S = clip_scale(labels, es)
+        G = ymirlib.tree_flatten(updates.weighted_sum(all_weights, alpha, offset=offset))
+        G = noise(G, self.lamb / S, jax.random.PRNGKey(self.rng.integers(2**31)))
         return self.G_unraveller(G)
 
     def step(self):
@@ -45,4 +54,76 @@ class Captain(captain.AggregateCaptain):
         all_weights = self.network(self.params, self.rng, return_weights=True)
 
         # Captain side update
-        self.params = self.update(all_weights)
\ No newline at end of file
+        self.params = self.update(all_weights)
+
+
+@jax.jit
+def distances(K):
+    """Find the pairwise cosine distances of the clients from the Gram matrix of their weights."""
+    D = jnp.clip(1 - ymirlib.cosine_from_gram(K), 0, 2)
+    return D * (1 - jnp.eye(D.shape[0], dtype=D.dtype))
+
+
+def hdbscan_cluster(D, min_cluster_size):
+    """Cluster the clients with HDBSCAN according to the matrix of their pairwise distances."""
+    return hdbscan.HDBSCAN(
+        min_cluster_size=min_cluster_size, metric='precomputed', allow_single_cluster=True
+    ).fit_predict(np.asarray(D, dtype=np.double))
+
+
+@partial(jax.jit, static_argnums=(1,))
+def mst_cluster(D, min_cluster_size):
+    """
+    Cluster the clients with single-linkage according to the matrix of their pairwise distances. The minimum spanning
+    tree is found with Prim's algorithm, then its edges are merged in order of increasing distance. After the merge that
+    forms a cluster of at least min_cluster_size clients, merging stops at the largest gap between consecutive
+    distances, so the cluster is the one that persists longest. That cluster is labelled 0 and the remaining clients
+    are labelled as noise.
+    """
+    n = D.shape[0]
+    if n < 2:
+        return jnp.zeros(n, dtype=jnp.int32)
+
+    def prim(carry, _):
+        in_tree, dist, parent = carry
+        j = jnp.argmin(jnp.where(in_tree, jnp.inf, dist))
+        edge = (parent[j], j, dist[j])
+        closer = D[j] < dist
+        return (in_tree.at[j].set(True), jnp.where(closer, D[j], dist), jnp.where(closer, j, parent)), edge
+
+    _, (u, v, w) = jax.lax.scan(prim, (jnp.arange(n) == 0, D[0], jnp.zeros(n, dtype=jnp.int32)), None, length=n - 1)
+    order = jnp.argsort(w)
+    u, v, w = u[order], v[order], w[order]
+
+    def merge(labels, edge):
+        a, b, merged = labels[edge[0]], labels[edge[1]], edge[2]
+        labels = jnp.where(merged & (labels == b), a, labels)
+        return labels, jnp.sum(labels == labels[edge[0]])
+
+    _, sizes = jax.lax.scan(merge, jnp.arange(n), (u, v, jnp.ones(n - 1, dtype=bool)))
+    formed = jnp.argmax(sizes >= min_cluster_size)
+    steps = jnp.arange(n - 1)
+    gaps = jnp.where(steps >= formed, jnp.append(w[1:] - w[:-1], -1), -jnp.inf)
+    cut = jnp.where(formed == n - 2, n - 2, jnp.argmax(gaps))
+    labels, _ = jax.lax.scan(merge, jnp.arange(n), (u, v, steps <= cut))
+    return jnp.where(jnp.bincount(labels, length=n)[labels] >= min_cluster_size, 0, -1)
+
+
+@jax.jit
+def clip_scale(labels, es):
+    """
+    Find the scale for the weighted average of the clipped weights of the clients in the largest cluster, along with the
+    median distance from the global weights that they are clipped to.
+    """
+    n = labels.shape[0]
+    counts = jnp.bincount(jnp.where(labels >= 0, labels, n), length=n + 1)[:n]
+    members = labels == jnp.argmax(counts)
+    S = jnp.median(es)
+    alpha = jnp.where(members, jnp.minimum(1, S / es), 0) / jnp.maximum(jnp.sum(members), 1)
+    return alpha.astype(jnp.float32), S
+
+
+@jax.jit
+def noise(G, sigma, key):
+    """Add Gaussian noise with standard deviation sigma to the flattened weights."""
+    return G + sigma * jax.random.normal(key, G.shape, G.dtype)
@@ -4,27 +4,34 @@ it is designed to provide robustness to (Sybil) adversarial attacks within non-i
 """
 
 import numpy as np
-import sklearn.metrics.pairwise as smp
 import jax
 import jax.numpy as jnp
 
+import ymirlib
+from ymir.mp import updates
+
 from . import captain
+from . import history
 
 
 class Captain(captain.ScaleCaptain):
-    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), kappa=1.0):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), kappa=1.0, sketch=None, memmap=None):
         """
         Construct the FoolsGold captain.
 
         Optional arguments:
         - kappa: value stating the distribution of classes across endpoints.
+        - sketch: if specified, sketch the histories to this many dimensions, see `history.History`.
+        - memmap: if specified, hold the histories on disk, True for a temporary file or a file path, see `history.create`.
         """
         super().__init__(params, opt, opt_state, network, rng)
-        self.histories = jnp.zeros((len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0]))
+        self.histories = history.create(
+            len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0], gram=True, sketch=sketch, memmap=memmap
+        )
         self.kappa = kappa
 
     def update(self, all_grads):
-        self.histories = update(self.histories, all_grads)
+        self.histories.update(all_grads, updates.get_ids(all_grads))
 
     def scale(self, all_grads):
         """
@@ -32,30 +39,39 @@ class Captain(captain.ScaleCaptain):
 
         Code adapted from `https://github.com/DistributedML/FoolsGold <https://github.com/DistributedML/FoolsGold>`_.
         """
-        n_clients = self.histories.shape[0]
-        cs = smp.cosine_similarity(self.histories) - np.eye(n_clients)
-        maxcs = np.max(cs, axis=1)
-        # pardoning
-        for i in range(n_clients):
-            for j in range(n_clients):
-                if i == j:
-                    continue
-                if maxcs[i] < maxcs[j]:
-                    cs[i][j] = cs[i][j] * maxcs[i] / maxcs[j]
-        wv = 1 - (np.max(cs, axis=1))
-        wv[wv > 1] = 1
-        wv[wv < 0] = 0
-        # Rescale so that max value is wv
-        wv = wv / np.max(wv)
-        wv[(wv == 1)] = .99
-        # Logit function
-        idx = wv != 0
-        wv[idx] = self.kappa * (np.log(wv[idx] / (1 - wv[idx])) + 0.5)
-        wv[(np.isinf(wv) + wv > 1)] = 1
-        wv[(wv < 0)] = 0
-        return wv
+        return similarity_scale(self.histories.similarity(updates.get_ids(all_grads)), self.kappa)
+
 
 @jax.jit
-def update(histories, all_grads):
-    """Perform histories + all_grads elementwise."""
-    return jnp.array([h + jax.flatten_util.ravel_pytree(g)[0] for h, g in zip(histories, all_grads)])
\ No newline at end of file
+def foolsgold(histories, kappa):
+    """
+    Find the FoolsGold weights of each client from their histories.
+
+    Arguments:
+    - histories: matrix of the flattened update histories, one row per client
+    - kappa: value stating the distribution of classes across endpoints
+    """
+    return similarity_scale(ymirlib.cosine_similarity(histories), kappa)
+
+
+@jax.jit
+def similarity_scale(cs, kappa):
+    """
+    Find the FoolsGold weights of each client from the pairwise cosine similarity of their histories.
+
+    Arguments:
+    - cs: the pairwise cosine similarity matrix of the histories
+    - kappa: value stating the distribution of classes across endpoints
+    """
+    cs = cs - jnp.eye(cs.shape[0])
+    maxcs = jnp.max(cs, axis=1)
+    # pardoning
+    cs = jnp.where(maxcs[:, None] < maxcs[None, :], cs * maxcs[:, None] / jnp.where(maxcs == 0, 1, maxcs)[None, :], cs)
+    wv = jnp.clip(1 - jnp.max(cs, axis=1), 0, 1)
+    # Rescale so that max value is wv, when all weights are 0 they remain so
+    maxwv = jnp.max(wv)
+    wv = wv / jnp.where(maxwv == 0, 1, maxwv)
+    wv = jnp.where(wv == 1, .99, wv)
+    # Logit function
+    wv = jnp.where(wv != 0, kappa * (jnp.log(wv / (1 - wv)) + 0.5), 0)
+    return jnp.clip(wv, 0, 1)
@@ -0,0 +1,274 @@
+r"""
+Storage of the per-client update histories used by the history based captains, such as FoolsGold, CONTRA, and Viceroy.
+"""
+
+import tempfile
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+import ymirlib
+from ymir.mp import updates
+
+
+class History:
+    r"""
+    The matrix $H \in \mathbb{R}^{n \times d}$ of per-client update histories, where each row is the history of a client.
+    Updates are applied as $H \gets \omega H + \Delta$ in a single fused operation that reuses the memory of $H$, so
+    only one copy of the histories is held. As a result, references to a previous value of `H` are invalidated by `update`.
+    The Gram matrix of the histories may also be maintained, giving the pairwise cosine similarities without a pass
+    over $H$ when only some of the rows change. For large models, the histories may instead be held in a sketched form,
+    where each update is projected to $k \ll d$ dimensions by a `CountSketch`, approximately preserving the inner
+    products between histories while reducing their storage and similarity computations to $O(nk)$.
+    """
+    def __init__(self, n, d, omega=1.0, dtype=jnp.float32, gram=False, sketch=None, key=jax.random.PRNGKey(0)):
+        """
+        Construct the history store.
+
+        Arguments:
+        - n: the number of clients
+        - d: the length of the flattened updates
+
+        Optional arguments:
+        - omega: the decay applied to the histories prior to adding each update
+        - dtype: the data type of the histories
+        - gram: if True, maintain the Gram matrix of the histories, updating only the changed rows and columns each round
+        - sketch: if specified, the number of dimensions to sketch the updates to
+        - key: the PRNG key used to generate the sketch
+        """
+        self.sketch = None if sketch is None else CountSketch(d, sketch, key)
+        self.H = jnp.zeros((n, d if sketch is None else sketch), dtype=dtype)
+        self.omega = omega
+        self.K = jnp.zeros((n, n), dtype=jnp.float32) if gram else None
+
+    def __len__(self):
+        return self.H.shape[0]
+
+    def get(self, ids=None):
+        """
+        Get the histories of the clients with the specified ids.
+
+        Arguments:
+        - ids: the ids of the clients, if None the histories of all clients are returned
+        """
+        return self.H if ids is None else self.H[ids]
+
+    def project(self, all_updates):
+        """
+        Get the updates in the form held within the histories, as a matrix with a row per client that is sketched if this
+        store is sketched.
+
+        Arguments:
+        - all_updates: the matrix of flattened updates, an UpdateMatrix, or a list of update pytrees
+        """
+        if isinstance(all_updates, updates.UpdateMatrix):
+            all_updates = all_updates.G
+        if self.sketch is None:
+            return updates.as_matrix(all_updates).G if isinstance(all_updates, list) else all_updates
+        return self.sketch(all_updates)
+
+    def similarity(self, ids=None):
+        """
+        Get the pairwise cosine similarity of the histories of the clients with the specified ids.
+
+        Arguments:
+        - ids: the ids of the clients, if None the similarities of all clients are returned
+        """
+        if self.K is None:
+            return ymirlib.cosine_similarity(self.get(ids))
+        return ymirlib.cosine_from_gram(self.K if ids is None else self.K[ids][:, ids])
+
+    def update(self, G, ids=None):
+        r"""
+        Add a matrix of updates to the histories, performing $H \gets \omega H + G$. When ids are given, only those rows
+        are updated, performing $H_{\text{ids}} \gets \omega H_{\text{ids}} + G$ at a cost proportional to the number of ids.
+
+        Arguments:
+        - G: the matrix of flattened updates, one row per client, an UpdateMatrix, or a list of update pytrees, which
+          are added to the histories leaf by leaf without being flattened
+        - ids: the ids of the clients that each of the rows of G are from, if None G holds the updates of all clients
+        """
+        if isinstance(G, updates.UpdateMatrix):
+            G = G.G
+        if self.sketch is not None:
+            G = self.sketch(G)
+        if isinstance(G, list):
+            self.H = update_tree(self.H, list(G), self.omega, ids)
+            if self.K is not None:
+                self.K = ymirlib.gram(self.H) if ids is None else ymirlib.gram_update_rows(self.K, self.H, ids)
+        elif ids is None:
+            self.H = update(self.H, G, self.omega)
+            if self.K is not None:
+                self.K = ymirlib.gram(self.H)
+        else:
+            self.H = update_rows(self.H, G, self.omega, ids)
+            if self.K is not None:
+                self.K = ymirlib.gram_update_rows(self.K, self.H, ids)
+        return self.H
+
+
+class MemmapHistory(History):
+    r"""
+    A `History` held on local disk with `np.memmap`, for populations where the $n \times d$ histories do not fit in
+    memory. The rows of the participating clients are streamed through in chunks for the updates, and in blocks of
+    columns for the similarities, so memory use is bounded by the chunk size rather than the number of clients. The
+    Gram matrix is not maintained in this form, instead the similarities of only the requested clients are computed.
+    """
+    def __init__(
+        self, n, d, omega=1.0, dtype=np.float32, sketch=None, key=jax.random.PRNGKey(0), path=None, chunk_size=2**24
+    ):
+        """
+        Construct the on disk history store.
+
+        Arguments:
+        - n: the number of clients
+        - d: the length of the flattened updates
+
+        Optional arguments:
+        - omega: the decay applied to the histories prior to adding each update
+        - dtype: the data type of the histories
+        - sketch: if specified, the number of dimensions to sketch the updates to
+        - key: the PRNG key used to generate the sketch
+        - path: the file to hold the histories in, if None a temporary file is used that is deleted with this object
+        - chunk_size: the maximum number of history elements to process at a time
+        """
+        self.sketch = None if sketch is None else CountSketch(d, sketch, key)
+        if path is None:
+            self._file = tempfile.NamedTemporaryFile(suffix=".dat")
+            path = self._file.name
+        self.H = np.memmap(path, dtype=dtype, mode='w+', shape=(n, d if sketch is None else sketch))
+        self.omega = omega
+        self.K = None
+        self.chunk_size = chunk_size
+
+    def get(self, ids=None):
+        return jnp.asarray(self.H if ids is None else self.H[np.asarray(ids)])
+
+    def similarity(self, ids=None):
+        rows = np.arange(len(self)) if ids is None else np.asarray(ids)
+        columns = max(1, self.chunk_size // max(len(rows), 1))
+        K = jnp.zeros((len(rows), len(rows)), dtype=jnp.float32)
+        for start in range(0, self.H.shape[1], columns):
+            K = K + ymirlib.gram(jnp.asarray(self.H[rows, start:start + columns]))
+        return ymirlib.cosine_from_gram(K)
+
+    def update(self, G, ids=None):
+        G = np.asarray(self.project(G), dtype=self.H.dtype)
+        rows = np.arange(len(self)) if ids is None else np.asarray(ids)
+        chunk_rows = max(1, self.chunk_size // self.H.shape[1])
+        for start in range(0, len(rows), chunk_rows):
+            chunk = rows[start:start + chunk_rows]
+            self.H[chunk] = self.omega * self.H[chunk] + G[start:start + chunk_rows]
+        return self.H
+
+
+def create(n, d, omega=1.0, gram=False, sketch=None, memmap=None):
+    """
+    Create the history store for a captain.
+
+    Arguments:
+    - n: the number of clients
+    - d: the length of the flattened updates
+
+    Optional arguments:
+    - omega: the decay applied to the histories prior to adding each update
+    - gram: if True, maintain the Gram matrix of in memory histories
+    - sketch: if specified, the number of dimensions to sketch the updates to
+    - memmap: if specified, hold the histories on disk with a `MemmapHistory`, either True for a temporary file or the
+      path of the file to use
+    """
+    if not memmap:
+        return History(n, d, omega=omega, gram=gram, sketch=sketch)
+    return MemmapHistory(n, d, omega=omega, sketch=sketch, path=None if memmap is True else memmap)
+
+
+class CountSketch:
+    r"""
+    A fixed count-sketch projection from $d$ to $k$ dimensions. Each coordinate of the input is given a random sign and
+    added into one of $k$ random buckets, so the projection costs $O(d)$ per update without forming a $k \times d$
+    matrix, and inner products are preserved in expectation.
+    """
+    def __init__(self, d, k, key=jax.random.PRNGKey(0)):
+        """
+        Construct the sketch.
+
+        Arguments:
+        - d: the number of input dimensions
+        - k: the number of sketched dimensions
+
+        Optional arguments:
+        - key: the PRNG key used to generate the buckets and signs
+        """
+        bucket_key, sign_key = jax.random.split(key)
+        self.buckets = jax.random.randint(bucket_key, (d,), 0, k)
+        self.signs = jnp.where(jax.random.bernoulli(sign_key, 0.5, (d,)), 1.0, -1.0)
+        self.k = k
+
+    def __call__(self, G):
+        """
+        Sketch a collection of updates.
+
+        Arguments:
+        - G: the matrix of flattened updates, one row per client, or a list of update pytrees, which are sketched leaf by
+          leaf without being flattened
+        """
+        if isinstance(G, list):
+            return sketch_tree(list(G), self.buckets, self.signs, self.k)
+        return sketch(G, self.buckets, self.signs, self.k)
+
+
+@partial(jax.jit, static_argnums=(3,))
+def sketch(G, buckets, signs, k):
+    """Count-sketch each of the rows of G into k dimensions."""
+    return jax.ops.segment_sum((G * signs).T, buckets, k).T
+
+
+def sketch_tree(all_updates, buckets, signs, k):
+    """Count-sketch each of a list of update pytrees into k dimensions, one stacked leaf at a time."""
+    S = 0
+    offset = 0
+    for x in ymirlib.tree_stack_leaves(all_updates):
+        columns = slice(offset, offset + x.shape[1])
+        S = S + sketch(x, buckets[columns], signs[columns], k)
+        offset += x.shape[1]
+    return S
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def update(H, G, omega):
+    r"""Perform $\omega H + G$, writing the result into the memory of H."""
+    return (omega * H + G).astype(H.dtype)
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def update_rows(H, G, omega, ids):
+    r"""Perform $H_{\text{ids}} \gets \omega H_{\text{ids}} + G$, writing the result into the memory of H."""
+    return H.at[ids].set((omega * H[ids] + G).astype(H.dtype))
+
+
+def update_tree(H, all_updates, omega, ids=None):
+    r"""
+    Perform $H_{\text{ids}} \gets \omega H_{\text{ids}} + G$, where G is given as a list of update pytrees. Each leaf is
+    stacked and added into its columns of H in turn, so only a single stacked leaf is held alongside H at a time.
+    """
+    H = decay(H, omega, ids)
+    offset = 0
+    for x in ymirlib.tree_stack_leaves(all_updates):
+        H = add_columns(H, x, offset, ids)
+        offset += x.shape[1]
+    return H
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def decay(H, omega, ids=None):
+    r"""Perform $H_{\text{ids}} \gets \omega H_{\text{ids}}$, writing the result into the memory of H."""
+    return omega * H if ids is None else H.at[ids].multiply(omega)
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def add_columns(H, x, offset, ids=None):
+    """Add the stacked leaf x into the columns of H starting at offset, in the rows at ids or all rows if ids is None."""
+    rows = jnp.arange(H.shape[0]) if ids is None else ids
+    return H.at[rows[:, None], offset + jnp.arange(x.shape[1])].add(x.astype(H.dtype))
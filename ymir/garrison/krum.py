@@ -3,34 +3,106 @@ The multi-Krum algorithm proposed in `https://papers.nips.cc/paper/2017/hash/f4b
 it is designed to be robust to Byzantine faults with i.i.d. environments.
 """
 
+from functools import partial
+
 import numpy as np
 import jax
+import jax.numpy as jnp
+
+import ymirlib
+from ymir.mp import updates
 
 from . import captain
 
 
 class Captain(captain.ScaleCaptain):
-    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), clip=3):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), clip=3, multi=True, block_size=64):
         """
         Construct the Krum captain.
 
         Optional arguments:
         - clip: the number of expected faults in each round.
+        - multi: if True, select the clients according to multi-Krum else only select the single client chosen by Krum.
+        - block_size: the number of rows of the pairwise distance matrix to compute at a time.
         """
         super().__init__(params, opt, opt_state, network, rng)
         self.clip = clip
+        self.multi = multi
+        self.block_size = block_size
 
     def update(self, all_grads):
         pass
 
     def scale(self, all_grads):
-        n = len(all_grads)
-        X = np.array([jax.flatten_util.ravel_pytree(g)[0] for g in all_grads])
-        scores = np.zeros(n)
-        distances = np.sum(X**2, axis=1)[:, None] + np.sum(X**2, axis=1)[None] - 2 * np.dot(X, X.T)
-        for i in range(len(X)):
-            scores[i] = np.sum(np.sort(distances[i])[1:((n - self.clip) - 1)])
-        idx = np.argpartition(scores, n - self.clip)[:(n - self.clip)]
-        alpha = np.zeros(n)
-        alpha[idx] = 1
-        return alpha
\ No newline at end of file
+        K = updates.gram(all_grads, self.block_size)
+        krum_idx, multi_alpha = gram_select(K, self.clip, self.block_size)
+        if self.multi:
+            return multi_alpha
+        return jnp.zeros(K.shape[0], dtype=jnp.float32).at[krum_idx].set(1)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def select(G, clip, block_size=64):
+    """
+    Find the Krum and multi-Krum selections of the clients.
+
+    Arguments:
+    - G: the matrix of flattened updates, one row per client
+    - clip: the number of expected faults
+    - block_size: the number of rows of the pairwise distance matrix to compute at a time
+
+    Returns the index of the client selected by Krum and the multi-Krum mask of the n - clip selected clients.
+    """
+    return gram_select(ymirlib.gram(G, block_size), clip, block_size)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def gram_select(K, clip, block_size=64):
+    """
+    Find the Krum and multi-Krum selections of the clients from the Gram matrix of their updates, see `select`.
+    """
+    n = K.shape[0]
+    s = gram_scores(K, max(n - clip - 2, 0), block_size)
+    multi_idx = jax.lax.top_k(-s, n - clip)[1]
+    return jnp.argmin(s), jnp.zeros(n, dtype=jnp.float32).at[multi_idx].set(1)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def scores(G, k, block_size=64):
+    """
+    Find the Krum score of each client, the sum of the squared distances to its k nearest neighbours.
+
+    Arguments:
+    - G: the matrix of flattened updates, one row per client
+    - k: the number of neighbours
+    - block_size: the number of rows of the pairwise distance matrix to compute at a time
+    """
+    return gram_scores(ymirlib.gram(G, block_size), k, block_size)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def gram_scores(K, k, block_size=64):
+    """
+    Find the Krum score of each client from the Gram matrix of their updates. The distances are found in blocks of rows,
+    so only a block_size by n portion of the distance matrix is held at a time.
+
+    Arguments:
+    - K: the Gram matrix of the updates
+    - k: the number of neighbours
+    - block_size: the number of rows of the pairwise distance matrix to compute at a time
+    """
+    n = K.shape[0]
+    block_size = min(block_size, n)
+    sq_norms = jnp.diag(K)
+
+    def block_scores(args):
+        Kb, sq_norms_b = args
+        distances = sq_norms_b[:, None] + sq_norms[None] - 2 * Kb
+        # The nearest of the distances is the client to itself, so it is excluded
+        return -jnp.sum(jax.lax.top_k(-distances, k + 1)[0][:, 1:], axis=1)
+
+    nblocks = -(-n // block_size)
+    pad = nblocks * block_size - n
+    Kb = jnp.pad(K, ((0, pad), (0, 0))).reshape(nblocks, block_size, n)
+    sq_norms_b = jnp.pad(sq_norms, (0, pad)).reshape(nblocks, block_size)
+    return jax.lax.map(block_scores, (Kb, sq_norms_b)).reshape(-1)[:n]
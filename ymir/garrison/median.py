@@ -0,0 +1,33 @@
+"""
+The coordinate-wise median proposed in `https://arxiv.org/abs/1803.01498 <https://arxiv.org/abs/1803.01498>`_
+it is designed to be robust to Byzantine faults, tolerating up to half of the clients being faulty.
+"""
+
+import numpy as np
+
+from . import trimmed_mean
+
+
+class Captain(trimmed_mean.Captain):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), block_size=256):
+        """
+        Construct the median captain, the median is found as the trimmed mean that keeps only the middle one or two
+        values of each coordinate.
+
+        Optional arguments:
+        - block_size: the number of coordinates to aggregate at a time.
+        """
+        super().__init__(params, opt, opt_state, network, rng, clip=len(network), block_size=block_size)
+
+
+def median(G, block_size=256):
+    """
+    Find the coordinate-wise median of the updates.
+
+    Arguments:
+    - G: the matrix of flattened updates, one row per client
+    - block_size: the number of coordinates to aggregate at a time
+
+    Returns the aggregate of each of the coordinates, and the share of the aggregate from each of the clients.
+    """
+    return trimmed_mean.trimmed_mean(G, (G.shape[0] - 1) // 2, block_size)
@@ -7,10 +7,12 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 
+from ymir.mp import updates
+
 from . import captain
 
 
-class Captain(captain.ScaleCaptain):
+class Captain(captain.CompiledScaleCaptain):
     def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), M=1.0):
         """
         Construct the norm clipping aggregator.
@@ -25,5 +27,14 @@ class Captain(captain.ScaleCaptain):
         pass
 
     def scale(self, all_grads):
-        G = jnp.array([jax.flatten_util.ravel_pytree(g)[0] for g in all_grads])
-        return jax.vmap(lambda g: 1 / jnp.maximum(1, jnp.linalg.norm(g, ord=2) / self.M))(G)
\ No newline at end of file
+        return 1 / jnp.maximum(1, updates.norms(all_grads) / self.M)
+
+    def compiled_scale(self):
+        return scale, (self.M,)
+
+
+@jax.jit
+def scale(all_grads, ids, M):
+    """Scale the stacked gradients down to the $l_2$ sphere of radius M"""
+    norms = jnp.sqrt(sum(jnp.sum(x.reshape(x.shape[0], -1)**2, axis=1) for x in jax.tree_leaves(all_grads)))
+    return 1 / jnp.maximum(1, norms / M)
@@ -11,6 +11,8 @@ import optax
 import numpy as np
 from sklearn import mixture
 
+from ymir.mp import updates
+
 from . import captain
 
 
@@ -64,16 +66,18 @@ def _relative_euclidean_distance(a, b):
     return jnp.linalg.norm(a - b, ord=2) / jnp.clip(jnp.linalg.norm(a, ord=2), a_min=1e-10)
 
 
-def _predict(params, net, gmm, X):
-    """Make the STD-DAGMM prediction."""
-    enc, dec = net.apply(params, X)
-    z = jnp.array([[
-        jnp.squeeze(e),
-        _relative_euclidean_distance(x, d),
-        optax.cosine_similarity(x, d),
-        jnp.std(x)
-    ] for x, e, d in zip(X, enc, dec)])
-    return gmm.score_samples(z)
+def _feature(x, e, d):
+    """Find the GMM features of an update from its encoding and decoding."""
+    return jnp.stack([jnp.squeeze(e), _relative_euclidean_distance(x, d), optax.cosine_similarity(x, d), jnp.std(x)])
+
+
+def _features(net):
+    """Extract the GMM features of each of the rows of the update matrix with the autoencoder."""
+    @jax.jit
+    def _apply(params, X):
+        enc, dec = net.apply(params, X)
+        return jax.vmap(_feature)(X, enc, dec)
+    return _apply
 
 
 # Algorithm functions/classes
@@ -90,27 +94,37 @@ class Captain(captain.ScaleCaptain):
         opt = optax.adamw(0.001, weight_decay=0.0001)
         self.da_opt_state = opt.init(self.da_params)
         self.da_update = _da_update(opt, _loss(self.da))
+        self.da_features = _features(self.da)
+        self.round = 0
+        self.features = (None, None)
 
         self.gmm = mixture.GaussianMixture(4, random_state=0, warm_start=True)
 
     def update(self, all_grads):
         self.batch_sizes = jnp.array([c.batch_size * c.epochs for c in self.network.clients])
-        grads = jnp.array([jax.flatten_util.ravel_pytree(g)[0].tolist() for g in all_grads])
+        grads = updates.as_matrix(all_grads).G
         self.da_params, self.da_opt_state = self.da_update(self.da_params, self.da_opt_state, grads)
-        enc, dec = self.da.apply(self.da_params, grads)
-        z = jnp.array([[
-            jnp.squeeze(e),
-            _relative_euclidean_distance(x, d),
-            optax.cosine_similarity(x, d),
-            jnp.std(x)
-        ] for x, e, d in zip(grads, enc, dec)])
-        self.gmm = self.gmm.fit(z)
+        self.round += 1
+        self.gmm = self.gmm.fit(np.asarray(self.get_features(all_grads, grads)))
 
     def scale(self, all_grads):
-        grads = jnp.array([jax.flatten_util.ravel_pytree(g)[0].tolist() for g in all_grads])
-        energies = _predict(self.da_params, self.da, self.gmm, grads)
+        energies = self.gmm.score_samples(np.asarray(self.get_features(all_grads)))
         std = jnp.std(energies)
         avg = jnp.mean(energies)
         mask = jnp.where((energies >= avg - std) * (energies <= avg + std), 1, 0)
-        total_dc = jnp.sum(self.batch_sizes * mask)
-        return (self.batch_sizes / total_dc) * mask
\ No newline at end of file
+        ids = updates.get_ids(all_grads)
+        batch_sizes = self.batch_sizes if ids is None else self.batch_sizes[ids]
+        total_dc = jnp.sum(batch_sizes * mask)
+        return (batch_sizes / total_dc) * mask
+
+    def get_features(self, all_grads, grads=None):
+        """
+        Get the GMM features of the updates given to the latest update with the current autoencoder, the features are
+        computed once for each round. Only the round is kept with the features, so the updates are not held on to
+        between rounds.
+        """
+        if self.features[0] != self.round:
+            if grads is None:
+                grads = updates.as_matrix(all_grads).G
+            self.features = (self.round, self.da_features(self.da_params, grads))
+        return self.features[1]
@@ -0,0 +1,157 @@
+"""
+The coordinate-wise trimmed mean proposed in `https://arxiv.org/abs/1803.01498 <https://arxiv.org/abs/1803.01498>`_
+it is designed to be robust to Byzantine faults by discarding the most extreme values of each coordinate.
+
+This module also holds the blockwise coordinate-wise kernel that the median and Bulyan captains are built on.
+"""
+
+from functools import partial
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from ymir.mp import updates
+
+from . import captain
+
+
+class Captain(captain.AggregateCaptain):
+    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), clip=3, block_size=256):
+        """
+        Construct the trimmed mean captain. The coordinate-wise aggregate is not a reweighting of the updates, so rather
+        than a scale this captain gives the share of the aggregate from each of the clients.
+
+        Optional arguments:
+        - clip: the number of expected faults in each round, this many of the largest and smallest values of each
+          coordinate are discarded.
+        - block_size: the number of coordinates to aggregate at a time.
+        """
+        super().__init__(params, opt, opt_state, network, rng)
+        self.clip = clip
+        self.block_size = block_size
+
+    def update(self, all_grads):
+        """
+        Find the global parameters after a step of the optimizer using the coordinate-wise aggregate of the gradients,
+        without storing them.
+        """
+        return self.update_params(self.params, self.opt_state, self.aggregate(all_grads)[1])[0]
+
+    def aggregate(self, all_grads):
+        """
+        Find the share of the aggregate from each client, the mean over the coordinates of the weight given to its
+        value, and the coordinate-wise aggregate of the updates as a pytree.
+        """
+        matrix = updates.as_matrix(all_grads)
+        n = len(matrix)
+        g, alpha = trimmed_mean(matrix.G, min(self.clip, (n - 1) // 2), self.block_size)
+        return alpha, matrix.unraveller(g)
+
+    def step(self):
+        """
+        Get the gradients from the network, then apply a step of the optimizer to the stored global parameters using
+        their coordinate-wise aggregate. Returns the share of the aggregate from each client and the gradients scaled by
+        those shares.
+        """
+        # Client side updates
+        all_grads = self.network(self.params, self.rng)
+
+        # Captain side aggregation
+        alpha, grads = self.aggregate(all_grads)
+
+        # Captain side update
+        self.params, self.opt_state = self.update_params(self.params, self.opt_state, grads)
+        return alpha, captain.apply_scale(alpha, all_grads)
+
+
+def coordinatewise(weigh, G, block_size=256):
+    """
+    Aggregate the updates coordinate by coordinate, a block of columns of G at a time so the memory used is bounded by
+    the block size rather than the length of the updates. This is intended to be traced within a jitted aggregator.
+
+    Arguments:
+    - weigh: function taking an n by block_size block of G and returning the weight of each of its values in the
+      aggregate of their column, the weights of each column are normalized to sum to 1
+    - G: the matrix of flattened updates, one row per client
+    - block_size: the number of coordinates to aggregate at a time
+
+    Returns the aggregate of each of the coordinates, and the share of the aggregate from each of the clients.
+    """
+    n, d = G.shape
+    block_size = min(block_size, d)
+    nblocks = -(-d // block_size)
+    # The final block is shifted back to end at d, so its leading columns overlap with the previous block
+    starts = jnp.minimum(jnp.arange(nblocks) * block_size, d - block_size)
+    overlap = nblocks * block_size - d
+
+    def block_aggregate(args):
+        i, start = args
+        X = jax.lax.dynamic_slice(G, (0, start), (n, block_size))
+        W = weigh(X)
+        # The weights are normalized by their total, and applied to the offsets from the most heavily weighted value,
+        # so the rounding of the weights neither scales the aggregate nor moves a column of identical values
+        total = jnp.sum(W, axis=0)
+        ref = jnp.take_along_axis(X, jnp.argmax(W, axis=0)[None], axis=0)[0]
+        W = W * (jnp.arange(block_size) >= jnp.where(i == nblocks - 1, overlap, 0))
+        return ref + jnp.sum(W * (X - ref), axis=0) / total, jnp.sum(W / total, axis=1)
+
+    g, shares = jax.lax.map(block_aggregate, (jnp.arange(nblocks), starts))
+    g = jnp.concatenate((g[:-1].reshape(-1), g[-1, overlap:]))
+    return g, (jnp.sum(shares, axis=0) / d).astype(jnp.float32)
+
+
+def order_statistic(X, k):
+    """
+    Find the kth smallest value of each column of X. Rather than sorting, the value is found by a bisection over the
+    order preserving integer keys of the floats, taking a counting pass over X for each of the bits of the float type.
+    """
+    bits = jnp.finfo(X.dtype).bits
+    itype = {16: jnp.int16, 32: jnp.int32, 64: jnp.int64}[bits]
+    limits = jnp.iinfo(itype)
+    u = jax.lax.bitcast_convert_type(X, itype)
+    keys = jnp.where(u < 0, u ^ limits.max, u)
+
+    def bisect(_, bounds):
+        lo, hi = bounds
+        mid = (lo >> 1) + (hi >> 1) + (lo & hi & 1)
+        lower = jnp.sum(keys <= mid, axis=0) > k
+        return jnp.where(lower, lo, mid + 1), jnp.where(lower, mid, hi)
+
+    lo, _ = jax.lax.fori_loop(
+        0, bits, bisect, (jnp.full(X.shape[1], limits.min, itype), jnp.full(X.shape[1], limits.max, itype))
+    )
+    return jnp.min(jnp.where(keys >= lo, X, jnp.inf), axis=0)
+
+
+def smallest_weights(X, k):
+    """
+    Weigh the values of each column of X for the sum of its k smallest, values tied with the kth smallest share the
+    remaining weight.
+    """
+    threshold = order_statistic(X, k - 1)
+    below = X < threshold
+    ties = X == threshold
+    remainder = (k - jnp.sum(below, axis=0)) / jnp.sum(ties, axis=0)
+    return below + ties * remainder
+
+
+def trimmed_weights(X, b):
+    """Weigh the values of each column of X for their mean after discarding the b largest and b smallest."""
+    n = X.shape[0]
+    return (smallest_weights(X, n - b) - smallest_weights(X, b)) / (n - 2 * b) if b > 0 else jnp.full_like(X, 1 / n)
+
+
+@partial(jax.jit, static_argnums=(1, 2))
+def trimmed_mean(G, b, block_size=256):
+    """
+    Find the coordinate-wise trimmed mean of the updates.
+
+    Arguments:
+    - G: the matrix of flattened updates, one row per client
+    - b: the number of the largest and smallest values of each coordinate to discard
+    - block_size: the number of coordinates to aggregate at a time
+
+    Returns the aggregate of each of the coordinates, and the share of the aggregate from each of the clients.
+    """
+    return coordinatewise(partial(trimmed_weights, b=b), G, block_size)
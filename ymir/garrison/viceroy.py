@@ -3,71 +3,112 @@ Viceroy algorithm for mitigating the impact of the on-off toggling attack.
 """
 
 import sys
-from functools import partial
 
 import numpy as np
-import sklearn.metrics.pairwise as smp
 
 import jax
 import jax.numpy as jnp
 
+import ymirlib
+from ymir.mp import updates
+
 from . import captain
+from . import foolsgold
+from . import history
 
 
 class Captain(captain.ScaleCaptain):
-    def __init__(self, params, opt, opt_state, network, rng=np.random.default_rng(), tau_0=56, tau_1=5):
+    def __init__(
+        self, params, opt, opt_state, network, rng=np.random.default_rng(), tau_0=56, tau_1=5, sketch=None, memmap=None
+    ):
         r"""
         Construct the Viceroy captain.
 
         Optional arguments:
         - tau_0: amount of rounds for the reputation to decay to 0 ($\tau_0$).
         - tau_1: amount of rounds for the reputation to build to 1 ($\tau_1$).
+        - sketch: if specified, sketch the histories and current updates to this many dimensions, see `history.History`.
+        - memmap: if specified, hold the histories on disk, True for a temporary file or a file path, see `history.create`.
         """
         super().__init__(params, opt, opt_state, network, rng)
-        self.histories = jnp.zeros((len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0]))
-        self.reps = np.array([1.0 for _ in range(len(network))])
-        self.round = 1
         self.omega = (abs(sys.float_info.epsilon))**(1/tau_0)
+        self.histories = history.create(
+            len(network), jax.flatten_util.ravel_pytree(params)[0].shape[0],
+            omega=self.omega, gram=True, sketch=sketch, memmap=memmap
+        )
+        self.reps = jnp.ones(len(network), dtype=jnp.float32)
+        self.round = 1
         self.eta = 1 / tau_1
+        self.history_scale = (None, None)
+        self.current = (None, None)
 
     def update(self, all_grads):
-        if self.round > 1:
-            history_scale = scale(self.histories)
-            current_scale = scale(jnp.array([jax.flatten_util.ravel_pytree(g)[0] for g in all_grads]))
-            self.reps = jnp.clip(self.reps + ((1 - 2 * abs(history_scale - current_scale)) / 2) * self.eta, 0, 1)
+        ids = updates.get_ids(all_grads)
+        history_scale = self.get_history_scale(ids) if self.round > 1 else None
         self.round += 1
-        self.histories = update(self.omega, self.histories, all_grads)
+        if history_scale is not None:
+            self.reps = update_reps(self.reps, ids, history_scale, self.current_scale(all_grads), self.eta)
+        self.histories.update(all_grads, ids)
+        # The scale of the new histories is used for both this round's aggregation and, when the same clients
+        # participate, the next round's reputation update
+        self.history_scale = (ids, scale(self.histories.similarity(ids)))
 
     def scale(self, all_grads):
-        return (self.reps * scale(self.histories)) + ((1 - self.reps) * scale(jnp.array([jax.flatten_util.ravel_pytree(g)[0] for g in all_grads])))
-
-
-def scale(X):
-    """A modified FoolsGold algorithm for scaling the gradients/histories."""
-    n_clients = X.shape[0]
-    cs = smp.cosine_similarity(X) - np.eye(n_clients)
-    maxcs = np.max(cs, axis=1)
-    # pardoning
-    for i in range(n_clients):
-        for j in range(n_clients):
-            if i == j:
-                continue
-            if maxcs[i] < maxcs[j]:
-                cs[i][j] = cs[i][j] * maxcs[i] / maxcs[j]
-    wv = 1 - (np.max(cs, axis=1))
-    wv[wv > 1] = 1
-    wv[wv < 0] = 0
-    # Rescale so that max value is wv
-    wv = wv / np.max(wv)
-    wv[(wv == 1)] = .99
-    # Logit function
-    idx = wv != 0
-    wv[idx] = (np.log(wv[idx] / (1 - wv[idx])) + 0.5)
-    wv[(np.isinf(wv) + wv > 1)] = 1
-    wv[(wv < 0)] = 0
-    return wv
-
-@partial(jax.jit, static_argnums=(0,))
-def update(omega, histories, all_grads):
-    r"""A decayed histories update, $H_{i, t + 1} \gets \omega H_{i, t} + \Delta_{i, t + 1} : \forall i \in \mathcal{U}$."""
-    return jnp.array([omega * h + jax.flatten_util.ravel_pytree(g)[0] for h, g in zip(histories, all_grads)])
\ No newline at end of file
+        ids = updates.get_ids(all_grads)
+        reps = self.reps if ids is None else self.reps[ids]
+        return (reps * self.get_history_scale(ids)) + ((1 - reps) * self.current_scale(all_grads))
+
+    def get_history_scale(self, ids=None):
+        """Get the scale of the histories of the clients with the specified ids, reusing the last computed scale where possible."""
+        cached_ids, history_scale = self.history_scale
+        order = None if history_scale is None else _id_order(cached_ids, ids)
+        if order is None:
+            self.history_scale = (ids, scale(self.histories.similarity(ids)))
+            return self.history_scale[1]
+        return history_scale[order]
+
+    def current_scale(self, all_grads):
+        """
+        Get the scale of the current updates, those given to the latest update, computed only once for each round. Only
+        the round is kept with the scale, so the updates are not held on to between rounds.
+        """
+        if self.current[0] != self.round:
+            if self.histories.sketch is None:
+                cs = ymirlib.cosine_from_gram(updates.gram(all_grads))
+            else:
+                cs = ymirlib.cosine_similarity(self.histories.project(all_grads))
+            self.current = (self.round, scale(cs))
+        return self.current[1]
+
+
+def _id_order(a, b):
+    """
+    Find the positions within the client ids a of each of the client ids b, where None states all clients, or None if
+    they are not the same collection of clients. The clients are sampled in a different order each round, so the scale
+    of the same clients can be reused by reordering it.
+    """
+    if a is None or b is None:
+        return slice(None) if a is None and b is None else None
+    a, b = np.asarray(a), np.asarray(b)
+    if a.shape != b.shape:
+        return None
+    sorter = np.argsort(a)
+    order = sorter[np.minimum(np.searchsorted(a, b, sorter=sorter), len(a) - 1)]
+    return order if np.array_equal(a[order], b) else None
+
+
+@jax.jit
+def scale(cs):
+    """A modified FoolsGold algorithm for scaling the gradients/histories, given their pairwise cosine similarity."""
+    return foolsgold.similarity_scale(cs, 1.0)
+
+
+@jax.jit
+def update_reps(reps, ids, history_scale, current_scale, eta):
+    """
+    Update the reputations of the clients with the specified ids, or all clients if ids is None, according to the
+    agreement between the scale of their histories and their current updates.
+    """
+    if ids is None:
+        return jnp.clip(reps + ((1 - 2 * abs(history_scale - current_scale)) / 2) * eta, 0, 1)
+    return reps.at[ids].set(jnp.clip(reps[ids] + ((1 - 2 * abs(history_scale - current_scale)) / 2) * eta, 0, 1))
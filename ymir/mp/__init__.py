@@ -9,4 +9,5 @@ from . import metrics
 from . import models
 from . import network
 from . import optimizers
+from . import updates
 from . import compression
\ No newline at end of file
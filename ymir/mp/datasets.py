@@ -2,25 +2,106 @@
 Load a dataset, handle the subset distribution, and provide an iterator.
 """
 
+from concurrent import futures
+from functools import partial
+import collections
 import numpy as np
 import os
+import jax
+import jax.numpy as jnp
 
 import datalib
 
 
-def load(dataset, dir="data"):
-    """Load a dataset according to the datalib module."""
+def load(dataset, dir="data", mmap=True, device=False):
+    """
+    Load a dataset according to the datalib module.
+
+    Arguments:
+    - dataset: the name of the dataset
+    - dir: the directory the datasets are stored in
+    - mmap: if True, the arrays are memory-mapped read-only from an uncompressed copy of the dataset, which is created
+      on the first load. Otherwise the compressed dataset, or the uncompressed copy if only that is stored, is read into
+      memory
+    - device: if True, the dataset is additionally placed on device, see `Dataset`
+
+    Datasets stored as integers, such as the uint8 image datasets, are loaded with the scale and offset that normalizes them.
+    """
     fn = f"{dir}/{dataset}.npz"
-    if not os.path.exists(fn):
+    if not os.path.exists(fn) and not os.path.isdir(f"{dir}/{dataset}"):
         datalib.download(dir, dataset)
-    ds = np.load(f"{dir}/{dataset}.npz")
+    if mmap or not os.path.exists(fn):
+        path = datalib.unpack(dir, dataset)
+        for k in ['X', 'y', 'train']:
+            if not os.path.exists(f"{path}/{k}.npy"):
+                raise FileNotFoundError(f"Dataset {dataset} is missing {path}/{k}.npy")
+        X, y, train = (np.load(f"{path}/{k}.npy", mmap_mode='r' if mmap else None) for k in ['X', 'y', 'train'])
+        norm = {k: np.load(f"{path}/{k}.npy").item() for k in ['scale', 'offset'] if os.path.exists(f"{path}/{k}.npy")}
+        return Dataset(X, y, np.asarray(train), device=device, **norm)
+    ds = np.load(fn)
     X, y, train = ds['X'], ds['y'], ds['train']
-    return Dataset(X, y, train)
+    norm = {k: ds[k].item() for k in ['scale', 'offset'] if k in ds.files}
+    return Dataset(X, y, train, device=device, **norm)
+
+
+@jax.jit
+def normalize(X, scale, offset):
+    r"""Convert integer typed samples into float32 samples, $X \cdot scale + offset$, float samples are returned as is."""
+    if jnp.issubdtype(X.dtype, jnp.integer):
+        return X.astype(jnp.float32) * scale + offset
+    return X
+
+
+@partial(jax.jit, static_argnums=(5, 6))
+def sample(key, X, y, idx, length, batch_size, n):
+    """
+    Sample n batches in-graph, each drawn without replacement from the first length entries of the indices idx,
+    stacked along a new leading axis. Padding idx to a common size allows the sampling to be vectorized across clients.
+
+    Arguments:
+    - key: the jax random key
+    - X: the samples
+    - y: the labels
+    - idx: the indices of the samples to draw from
+    - length: the number of valid entries in idx
+    - batch_size: the batch size
+    - n: the number of batches
+    """
+    def _batch(key):
+        if batch_size * batch_size <= idx.shape[0]:
+            pos = _distinct(key, length, batch_size)
+        else:
+            # Large batches cover much of the indices, so a permutation of them costs about the same as the batch
+            pos = jnp.argsort(jax.random.uniform(key, idx.shape) + (jnp.arange(idx.shape[0]) >= length))[:batch_size]
+        return X[idx[pos]], y[idx[pos]]
+    return jax.vmap(_batch)(jax.random.split(key, n))
+
+
+def _distinct(key, length, k):
+    """
+    Draw k distinct positions uniformly from [0, length) with Floyd's algorithm, at a cost of $O(k^2)$ regardless of
+    length. This is intended to be traced within a jitted function.
+    """
+    keys = jax.random.split(key, k)
+
+    def draw(i, pos):
+        j = length - k + i
+        t = jax.random.randint(keys[i], (), 0, j + 1)
+        return pos.at[i].set(jnp.where(jnp.any(pos == t), j, t))
+
+    return jax.lax.fori_loop(0, k, draw, jnp.full(k, -1, dtype=jnp.int32))
+
+
+def _host_normalize(X, scale, offset):
+    """Convert integer typed samples into float32 samples on the host, float samples are returned as is."""
+    if np.issubdtype(X.dtype, np.integer):
+        return X.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    return X
 
 
 class DataIter:
     """Iterator that gives random batchs in pairs of $(X_i, y_i) : i \subseteq {1, \ldots, N}$"""
-    def __init__(self, X, y, batch_size, classes, rng):
+    def __init__(self, X, y, batch_size, classes, rng, idx=None, map=None, sampler="choice", scale=1.0, offset=0.0):
         """
         Construct a data iterator.
         
@@ -30,13 +111,106 @@ class DataIter:
         - batch_size: the batch size
         - classes: the number of classes
         - rng: the random number generator
+        - idx: the indices of the samples within X and y to iterate over, if None all samples are used. Batches are
+          gathered from X and y on demand, so they may be shared between iterators without copying
+        - map: a function that takes a batch of samples and labels and returns the transformed batch
+        - sampler: how batches are sampled, "choice" draws each batch without replacement independently of the others,
+          "permutation" shuffles the indices once per pass over the data and takes successive slices as the batches, and
+          "replacement" draws each batch with replacement
+        - scale: the scale that normalizes integer typed samples into float32
+        - offset: the offset added to the scaled integer typed samples
         """
+        if sampler not in ["choice", "permutation", "replacement"]:
+            raise ValueError(f"Sampler {sampler} not found")
         self.X = X
         self.y = y
-        self.batch_size = y.shape[0] if batch_size is None else min(batch_size, y.shape[0])
-        self.idx = np.arange(y.shape[0])
+        self.idx = np.arange(y.shape[0]) if idx is None else idx
+        self.batch_size = self.idx.shape[0] if batch_size is None else min(batch_size, self.idx.shape[0])
         self.classes = classes
         self.rng = rng
+        self.map = map
+        self.sampler = sampler
+        self.perm = None
+        self.perm_pos = 0
+        self.scale = scale
+        self.offset = offset
+
+    def __iter__(self):
+        """Return this as an iterator."""
+        return self
+
+    def __next__(self):
+        """Get a random batch."""
+        idx = self._sample()
+        X, y = self._normalize(self.X[idx]), self.y[idx]
+        if self.map is not None:
+            X, y = self.map(X, y)
+        return X, y
+
+    def next_n(self, n, raw=False):
+        """
+        Get n random batches stacked along a new leading axis, gathered from the data in a single step.
+        If raw and there is no map, the samples are left in their stored type, to be normalized on device with `normalize`.
+        """
+        idx = np.stack([self._sample() for _ in range(n)])
+        X, y = self.X[idx], self.y[idx]
+        if raw and self.map is None:
+            return X, y
+        X = self._normalize(X)
+        if self.map is not None:
+            X, y = (np.stack(b) for b in zip(*[self.map(bX, by) for bX, by in zip(X, y)]))
+        return X, y
+
+    def _normalize(self, X):
+        """
+        Convert integer typed samples into float32 samples. They are transferred in their stored type and converted on
+        device, unless they are to be mapped, which is done on the host.
+        """
+        if self.map is None and np.issubdtype(X.dtype, np.integer):
+            return normalize(X, self.scale, self.offset)
+        return _host_normalize(X, self.scale, self.offset)
+
+    def _sample(self):
+        """Get the indices of the next batch according to the sampler."""
+        if self.sampler == "replacement":
+            return self.idx[self.rng.integers(self.idx.shape[0], size=self.batch_size)]
+        if self.sampler == "permutation":
+            if self.perm is None or self.perm_pos + self.batch_size > self.perm.shape[0]:
+                self.perm = self.rng.permutation(self.idx)
+                self.perm_pos = 0
+            self.perm_pos += self.batch_size
+            return self.perm[self.perm_pos - self.batch_size:self.perm_pos]
+        return self.rng.choice(self.idx, self.batch_size, replace=False)
+
+
+class DeviceDataIter:
+    """
+    Iterator that gives random batches from device resident data, sampled in-graph with a jax random key so that no host
+    involvement is required. Standard clients with this data are trained with their sampling fused into the local training.
+    """
+    def __init__(self, X, y, batch_size, classes, key, idx=None, scale=1.0, offset=0.0):
+        """
+        Construct a device data iterator.
+
+        Arguments:
+        - X: the samples, on device
+        - y: the labels, on device
+        - batch_size: the batch size
+        - classes: the number of classes
+        - key: the jax random key
+        - idx: the indices of the samples within X and y to iterate over, if None all samples are used
+        - scale: the scale that normalizes integer typed samples into float32
+        - offset: the offset added to the scaled integer typed samples
+        """
+        self.X = X
+        self.y = y
+        self.idx = jnp.arange(y.shape[0]) if idx is None else jax.device_put(idx)
+        self.length = self.idx.shape[0]
+        self.batch_size = self.length if batch_size is None else min(batch_size, self.length)
+        self.classes = classes
+        self.key = key
+        self.scale = scale
+        self.offset = offset
 
     def __iter__(self):
         """Return this as an iterator."""
@@ -44,13 +218,94 @@ class DataIter:
 
     def __next__(self):
         """Get a random batch."""
-        idx = self.rng.choice(self.idx, self.batch_size, replace=False)
-        return self.X[idx], self.y[idx]
+        X, y = self.next_n(1)
+        return X[0], y[0]
+
+    def next_n(self, n, raw=False):
+        """Get n random batches stacked along a new leading axis, if raw the samples are left in their stored type."""
+        X, y = sample(self.next_key(), self.X, self.y, self.idx, self.length, self.batch_size, n)
+        return (X if raw else normalize(X, self.scale, self.offset)), y
+
+    def next_key(self):
+        """Get a new random key for sampling, advancing the stored key."""
+        self.key, key = jax.random.split(self.key)
+        return key
+
+
+class Prefetcher:
+    """
+    Wraps a data iterator so that its batches are drawn ahead of their use in a background thread and staged on device,
+    overlapping the data preparation with training. Attributes not defined here are taken from the wrapped iterator.
+    The batches are drawn in blocks of n, the form requested by `next_n(n)`, and individual batches are taken from the blocks.
+
+    As the batches are drawn in a background thread, iterators that share a random number generator with the main
+    thread should be given their own generator for runs to be reproducible, as `ymir.mp.network.Controller.prefetch` does.
+    """
+    def __init__(self, data, n=1, depth=2):
+        """
+        Construct the prefetcher.
+
+        Arguments:
+        - data: the data iterator to wrap
+        - n: the number of batches in each prefetched block, e.g. the number of local epochs of the client
+        - depth: the number of blocks to keep prefetched
+        """
+        self.data = data
+        self.n = n
+        self.depth = depth
+        self.blocks = collections.deque()
+        self.batches = collections.deque()
+        for _ in range(depth):
+            self._prefetch()
+
+    def __getattr__(self, name):
+        return getattr(self.data, name)
+
+    def __iter__(self):
+        """Return this as an iterator."""
+        return self
+
+    def __next__(self):
+        """Get the next batch as normalized device arrays."""
+        if not self.batches:
+            X, y = self._take()
+            self.batches.extend(zip(normalize(X, self.data.scale, self.data.offset), y))
+        return self.batches.popleft()
+
+    def next_n(self, n, raw=False):
+        """
+        Get n batches stacked along a new leading axis as device arrays, if raw the samples are left in their stored type.
+        """
+        if n != self.n or self.batches:
+            X, y = (jnp.stack(b) for b in zip(*[next(self) for _ in range(n)]))
+            return X, y
+        X, y = self._take()
+        return (X if raw else normalize(X, self.data.scale, self.data.offset)), y
+
+    def _take(self):
+        """Take the oldest prefetched block and start prefetching a new one."""
+        X, y = self.blocks.popleft().result()
+        self._prefetch()
+        return X, y
+
+    def _prefetch(self):
+        self.blocks.append(_executor().submit(lambda: jax.device_put(self.data.next_n(self.n, raw=True))))
+
+
+_EXECUTOR = None
+
+
+def _executor():
+    """Get the single background thread shared by the prefetchers, a single thread keeps the draws in submission order."""
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = futures.ThreadPoolExecutor(max_workers=1)
+    return _EXECUTOR
 
 
 class Dataset:
     """Object that contains the full dataset, primarily to prevent the need for reloading for each endpoint."""
-    def __init__(self, X, y, train):
+    def __init__(self, X, y, train, scale=1.0, offset=0.0, device=False):
         """
         Construct the dataset.
 
@@ -58,42 +313,57 @@ class Dataset:
         - X: the samples
         - y: the labels
         - train: the training indices
+        - scale: the scale that normalizes integer typed samples into float32
+        - offset: the offset added to the scaled integer typed samples
+        - device: if True, the samples and labels are placed on device once, and the iterators without a map are
+          `DeviceDataIter`s that sample from them in-graph
         """
         self.X, self.y, self.train_idx = X, y, train
+        self.scale, self.offset = scale, offset
         self.classes = np.unique(self.y).shape[0]
+        self.device = jax.device_put((X, y)) if device else None
 
     def train(self):
-        """Get the training subset"""
-        return self.X[self.train_idx], self.y[self.train_idx]
+        """Get the training subset, with the samples normalized into float32"""
+        return _host_normalize(self.X[self.train_idx], self.scale, self.offset), self.y[self.train_idx]
 
     def test(self):
-        """Get the testing subset"""
-        return self.X[~self.train_idx], self.y[~self.train_idx]
+        """Get the testing subset, with the samples normalized into float32"""
+        return _host_normalize(self.X[~self.train_idx], self.scale, self.offset), self.y[~self.train_idx]
+
+    def split_idx(self, split):
+        """Get the indices of the samples within the split, either "train" or "test"."""
+        return np.flatnonzero(self.train_idx if split == 'train' else ~self.train_idx)
 
-    def get_iter(self, split, batch_size=None, idx=None, filter=None, map=None, rng=np.random.default_rng()) -> DataIter:
+    def get_iter(self, split, batch_size=None, idx=None, filter=None, map=None, rng=np.random.default_rng(), sampler="choice"):
         """
-        Generate an iterator out of the dataset.
+        Generate an iterator out of the dataset, the iterator holds only the indices of its samples within this dataset.
         
         Arguments:
         - split: the split to use, either "train" or "test"
         - batch_size: the batch size
-        - idx: the indices to use
+        - idx: the indices to use, relative to the split
         - filter: a function that takes the labels and returns whether to keep the sample
-        - map: a function that takes the samples and labels and returns a subset of the samples and labels
+        - map: a function that takes the samples and labels and returns a subset of the samples and labels, it is applied
+          to each batch as it is drawn
         - rng: the random number generator
+        - sampler: the batch sampling scheme of the iterator, see `DataIter`, device iterators always sample each batch
+          without replacement
         """
-        X, y = self.train() if split == 'train' else self.test()
-        X, y = X.copy(), y.copy()
+        split_idx = self.split_idx(split)
         if idx is not None:
-            X, y = X[idx], y[idx]
+            split_idx = split_idx[idx]
         if filter is not None:
-            fidx = filter(y)
-            X, y = X[fidx], y[fidx]
-        if map is not None:
-            X, y = map(X, y)
-        return DataIter(X, y, batch_size, self.classes, rng)
+            split_idx = split_idx[filter(self.y[split_idx])]
+        if self.device is not None and map is None:
+            return DeviceDataIter(
+                *self.device, batch_size, self.classes, jax.random.PRNGKey(rng.integers(2**31)), idx=split_idx, scale=self.scale, offset=self.offset
+            )
+        return DataIter(
+            self.X, self.y, batch_size, self.classes, rng, idx=split_idx, map=map, sampler=sampler, scale=self.scale, offset=self.offset
+        )
     
-    def fed_split(self, batch_sizes, mapping=None, rng=np.random.default_rng()):
+    def fed_split(self, batch_sizes, mapping=None, rng=np.random.default_rng(), sampler="choice"):
         """
         Divide the dataset for federated learning.
         
@@ -101,8 +371,17 @@ class Dataset:
         - batch_sizes: the batch sizes for each endpoint
         - mapping: a function that takes the dataset information and returns the indices for each endpoint
         - rng: the random number generator
+        - sampler: the batch sampling scheme of the endpoint iterators, see `DataIter`
         """
         if mapping is not None:
-            distribution = mapping(*self.train(), len(batch_sizes), self.classes, rng)
-            return [self.get_iter("train", b, idx=d, rng=rng) for b, d in zip(batch_sizes, distribution)]
-        return [self.get_iter("train", b, rng=rng) for b in batch_sizes]
\ No newline at end of file
+            split_idx = self.split_idx("train")
+            distribution = mapping(_view(self.X, split_idx), self.y[split_idx], len(batch_sizes), self.classes, rng)
+            return [self.get_iter("train", b, idx=d, rng=rng, sampler=sampler) for b, d in zip(batch_sizes, distribution)]
+        return [self.get_iter("train", b, rng=rng, sampler=sampler) for b in batch_sizes]
+
+
+def _view(a, idx):
+    """Index a with idx, giving a view rather than a copy when idx is a contiguous range."""
+    if idx.shape[0] > 0 and idx[-1] - idx[0] + 1 == idx.shape[0]:
+        return a[idx[0]:idx[-1] + 1]
+    return a[idx]
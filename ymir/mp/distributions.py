@@ -8,23 +8,89 @@ All functions take the following arguments:
 - nclasses: the number of classes
 - rng: the random number generator
 
-And they all return a list of lists of indices, where the outer list is indexed by endpoint.
+And they all return a `Partition`, a compact sequence of index arrays indexed by endpoint.
 """
 
-import itertools
+import hashlib
+import json
+import os
+import tempfile
+from functools import partial
 
 import numpy as np
 from absl import logging
 
 
+class Partition:
+    """
+    Compact (CSR-style) representation of the distribution of data across endpoints. The indices of all endpoints are held
+    in a single array, where endpoint i owns the range idx[offsets[i, 0]:offsets[i, 1]]. Ranges may overlap, so endpoints
+    can share data without it being repeated. Indexing by endpoint gives a view of its indices.
+    """
+    def __init__(self, idx, offsets):
+        """
+        Construct the partition.
+
+        Arguments:
+        - idx: the concatenated indices of the endpoints
+        - offsets: the start and end of the range of idx belonging to each endpoint, with shape (nendpoints, 2)
+        """
+        self.idx = idx
+        self.offsets = offsets
+
+    def __len__(self):
+        return self.offsets.shape[0]
+
+    def __getitem__(self, i):
+        start, end = self.offsets[i]
+        return self.idx[start:end]
+
+    def __iter__(self):
+        return (self.idx[start:end] for start, end in self.offsets)
+
+
+def _contiguous(idx, lengths):
+    """Create the partition where consecutive endpoints own consecutive segments of idx with the given lengths."""
+    ends = np.cumsum(lengths)
+    return Partition(idx, np.stack((ends - lengths, ends), axis=1))
+
+
+def _by_endpoint(idx, endpoints, nendpoints):
+    """Group idx by the endpoint each element is assigned to, retaining the order of idx within each endpoint."""
+    order = np.argsort(endpoints, kind='stable')
+    return _contiguous(idx[order], np.bincount(endpoints, minlength=nendpoints))
+
+
+def _class_ranges(y, nclasses):
+    """Get the indices sorted by class, retaining ascending order within each class, and the range of each class."""
+    order = np.argsort(y, kind='stable')
+    ends = np.cumsum(np.bincount(y.astype(int), minlength=nclasses))
+    return order, np.stack((ends - np.bincount(y.astype(int), minlength=nclasses), ends), axis=1)
+
+
+def _gather_ranges(idx, starts, ends):
+    """Concatenate the ranges idx[starts[i]:ends[i]] with a single gather."""
+    lengths = ends - starts
+    return idx[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())]
+
+
+def as_partition(distribution):
+    """Convert a distribution given as a list of index arrays or boolean masks into a Partition"""
+    if isinstance(distribution, Partition):
+        return distribution
+    idx = [np.flatnonzero(d) if np.asarray(d).dtype == bool else np.asarray(d, dtype=int) for d in distribution]
+    return _contiguous(np.concatenate(idx), np.array([len(i) for i in idx]))
+
+
 def homogeneous(X, y, nendpoints, nclasses, rng):
-    """Assign all data to all endpoints"""
-    return [np.arange(len(y)) for _ in range(nendpoints)]
+    """Assign all data to all endpoints, each endpoint shares the same index array"""
+    return Partition(np.arange(len(y)), np.tile([0, len(y)], (nendpoints, 1)))
 
 
 def extreme_heterogeneous(X, y, nendpoints, nclasses, rng):
     """Assign each endpoint only the data from each class"""
-    return [np.isin(y, i % nclasses) for i in range(nendpoints)]
+    order, ranges = _class_ranges(y, nclasses)
+    return Partition(order, ranges[np.arange(nendpoints) % nclasses])
 
 
 def lda(X, y, nendpoints, nclasses, rng, alpha=0.5):
@@ -36,22 +102,25 @@ def lda(X, y, nendpoints, nclasses, rng, alpha=0.5):
     - alpha: the $\alpha$ parameter of the Dirichlet function,
     the distribution is more i.i.d. as $\alpha \to \infty$ and less i.i.d. as $\alpha \to 0$
     """
-    distribution = [[] for _ in range(nendpoints)]
     proportions = rng.dirichlet(np.repeat(alpha, nendpoints), size=nclasses)
+    idx, endpoints = [], []
     for c in range(nclasses):
         idx_c = np.where(y == c)[0]
         rng.shuffle(idx_c)
-        dists_c = np.split(idx_c, np.round(np.cumsum(proportions[c]) * len(idx_c)).astype(int)[:-1])
-        distribution = [distribution[i] + d.tolist() for i, d in enumerate(dists_c)]
+        bounds = np.concatenate(([0], np.round(np.cumsum(proportions[c]) * len(idx_c)).astype(int)[:-1], [len(idx_c)]))
+        idx.append(idx_c)
+        endpoints.append(np.repeat(np.arange(nendpoints), np.diff(np.clip(bounds, 0, len(idx_c)))))
     logging.debug(f"distribution: {proportions}")
-    return distribution
+    return _by_endpoint(np.concatenate(idx), np.concatenate(endpoints), nendpoints)
 
 
 def iid_partition(X, y, nendpoints, nclasses, rng):
     """Assign each endpoint iid the data from each class as defined in `https://arxiv.org/abs/1602.05629 <https://arxiv.org/abs/1602.05629>`_"""
     idx = np.arange(len(y))
     rng.shuffle(idx)
-    return np.split(idx, [round(i * (len(y) // nendpoints)) for i in range(1, nendpoints)])
+    lengths = np.full(nendpoints, len(y) // nendpoints)
+    lengths[-1] = len(y) - lengths[:-1].sum()
+    return _contiguous(idx, lengths)
 
 
 def shard(X, y, nendpoints, nclasses, rng, shards_per_endpoint=2):
@@ -63,9 +132,11 @@ def shard(X, y, nendpoints, nclasses, rng, shards_per_endpoint=2):
     - shards_per_endpoint: the number of shards to assign to each endpoint.
     """
     idx = np.argsort(y)  # sort by label
-    shards = np.split(idx, [round(i * (len(y) // (nendpoints * shards_per_endpoint))) for i in range(1, nendpoints * shards_per_endpoint)])
-    assignment = rng.choice(np.arange(len(shards)), (nendpoints, shards_per_endpoint), replace=False)
-    return [list(itertools.chain(*[shards[assignment[i][j]] for j in range(shards_per_endpoint)])) for i in range(nendpoints)]
+    nshards = nendpoints * shards_per_endpoint
+    bounds = np.concatenate((np.arange(nshards) * (len(y) // nshards), [len(y)]))
+    assignment = rng.choice(np.arange(nshards), (nendpoints, shards_per_endpoint), replace=False).reshape(-1)
+    starts, ends = bounds[assignment], bounds[assignment + 1]
+    return _contiguous(_gather_ranges(idx, starts, ends), (ends - starts).reshape(nendpoints, -1).sum(axis=1))
 
 
 def assign_classes(X, y, nendpoints, nclasses, rng, classes=None):
@@ -77,4 +148,59 @@ def assign_classes(X, y, nendpoints, nclasses, rng, classes=None):
     """
     if classes is None:
         raise ValueError("Classes not specified in distribution")
-    return [np.isin(y, classes[i]) for i in range(nendpoints)]
\ No newline at end of file
+    order, ranges = _class_ranges(y, nclasses)
+    endpoint_classes = [np.unique(np.atleast_1d(c)) for c in (classes[i] for i in range(nendpoints))]
+    assigned = ranges[np.concatenate(endpoint_classes)]
+    idx = _gather_ranges(order, assigned[:, 0], assigned[:, 1])
+    endpoints = np.repeat(np.arange(nendpoints), [(ranges[c, 1] - ranges[c, 0]).sum() for c in endpoint_classes])
+    # sort by endpoint then by index, giving each endpoint its indices in ascending order
+    idx = idx[np.lexsort((idx, endpoints))]
+    return _contiguous(idx, np.bincount(endpoints, minlength=nendpoints))
+
+
+def cache(mapping, dir="data/partitions"):
+    """
+    Wrap a mapping function so that the partitions it generates are saved to and reused from disk. Partitions are keyed
+    by the mapping and its parameters, the labels, the number of endpoints and classes, and the state of the random number
+    generator. Upon reuse, the generator is set to the state it had after originally generating the partition, so runs
+    are identical with or without the cache. Lambdas and local functions cannot be told apart by name, and their captured
+    state may not be stable across processes, so their partitions are generated without the cache.
+
+    Arguments:
+    - mapping: the mapping function to wrap
+    - dir: the directory to store the partitions in
+    """
+    description = _describe(mapping)
+
+    def _apply(X, y, nendpoints, nclasses, rng):
+        if description is None:
+            logging.warning(f"Not caching the partitions of {mapping}, as it is a lambda or a local function")
+            return as_partition(mapping(X, y, nendpoints, nclasses, rng))
+        key = hashlib.sha256(repr((
+            description, hashlib.sha256(np.ascontiguousarray(y)).hexdigest(), nendpoints, nclasses, rng.bit_generator.state
+        )).encode()).hexdigest()
+        fn = f"{dir}/{key}.npz"
+        if os.path.exists(fn):
+            with np.load(fn) as p:
+                rng.bit_generator.state = json.loads(str(p['rng_state']))
+                return Partition(p['idx'], p['offsets'])
+        partition = as_partition(mapping(X, y, nendpoints, nclasses, rng))
+        os.makedirs(dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=dir, suffix=".npz", delete=False) as f:
+            np.savez(f, idx=partition.idx, offsets=partition.offsets, rng_state=json.dumps(rng.bit_generator.state))
+        os.replace(f.name, fn)
+        return partition
+    return _apply
+
+
+def _describe(mapping):
+    """
+    Describe a mapping function and any of its bound arguments in a form that is stable across processes, or None if
+    the mapping is a lambda or a local function, which its name does not identify.
+    """
+    if isinstance(mapping, partial):
+        func = _describe(mapping.func)
+        return None if func is None else (func, mapping.args, sorted(mapping.keywords.items()))
+    if "<lambda>" in mapping.__qualname__ or "<locals>" in mapping.__qualname__:
+        return None
+    return (mapping.__module__, mapping.__qualname__)
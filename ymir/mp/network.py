@@ -4,9 +4,16 @@ Defines the network architecture for the FL system.
 
 
 import numpy as  np
+import jax
+import jax.flatten_util
+import jax.numpy as jnp
 import optax
 
 import ymirlib
+from ymir.regiment import scout
+
+from . import datasets
+from . import updates
 
 
 class Controller:
@@ -15,25 +22,42 @@ class Controller:
     Handles the update step of each of the clients and passes the respective gradients
     up the chain.
     """
-    def __init__(self, C):
+    def __init__(self, C, vectorize=False, stacked=False, delta=False):
         """
         Construct the Controller.
 
         Arguments:
         - C: percent of clients to randomly select for training at each round
+        - vectorize: if True, selected clients sharing an optimizer, loss function, batch size, and number of epochs
+          are trained together with a single vectorized update step
+        - stacked: if True, the updates are returned as a single `ymir.mp.updates.UpdateMatrix` rather than a list of pytrees
+        - delta: if True, clients asked for their weights instead return the difference between their weights and the
+          global parameters, $w_i - w$
         """
         self.clients = []
+        self.ids = []
         self.switches = []
         self.C = C
         self.K = 0
+        self.vectorize = vectorize
+        self.stacked = stacked
+        self.delta = delta
+        self.unraveller = None
         self.update_transform_chain = []
 
     def __len__(self):
         return len(self.clients) + sum([len(s) for s in self.switches])
 
-    def add_client(self, client):
-        """Connect a client directly to this controller"""
+    def add_client(self, client, id=None):
+        """
+        Connect a client directly to this controller
+
+        Arguments:
+        - client: the client to connect
+        - id: the id of the client within the network, defaults to its position within this controller
+        """
         self.clients.append(client)
+        self.ids.append(self.K if id is None else id)
         self.K += 1
 
     def add_switch(self, switch):
@@ -44,6 +68,21 @@ class Controller:
         """Add a function that transforms the updates before passing them up the chain"""
         self.update_transform_chain.append(update_transform)
 
+    def prefetch(self, depth=2):
+        """
+        Wrap the data of each of the connected clients in a `ymir.mp.datasets.Prefetcher`, so the batches for their local
+        epochs are prepared and staged on device in the background. As the batches are drawn in background threads, each
+        client's data is first given its own generator, spawned in turn from its current one, so that runs remain
+        reproducible when clients share a generator with each other or the client selection.
+        """
+        for c in self.clients:
+            if not isinstance(c.data, datasets.Prefetcher):
+                if isinstance(getattr(c.data, "rng", None), np.random.Generator):
+                    c.data.rng = c.data.rng.spawn(1)[0]
+                c.data = datasets.Prefetcher(c.data, c.epochs, depth)
+        for switch in self.switches:
+            switch.prefetch(depth)
+
     def __call__(self, params, rng=np.random.default_rng(), return_weights=False):
         """
         Update each connected client and return the generated update. Recursively call in connected controllers
@@ -51,35 +90,158 @@ class Controller:
         Arguments:
         - params: the parameters of the global model from the most recent round
         - rng: the random number generator to use
-        - return_weights: if True, return the weights of the clients else return the gradients from the local training
+        - return_weights: if True, return the weights of the clients, or their differences from params in delta mode, else
+          return the gradients from the local training
+
+        The updates are returned with the ids of the participating clients attached, see `ymir.mp.updates.get_ids`.
         """
         all_updates = []
+        ids = []
         for switch in self.switches:
-            all_updates.extend(switch(params, rng, return_weights))
+            switch_updates = switch(params, rng, return_weights)
+            all_updates.extend(switch_updates)
+            ids.extend(updates.get_ids(switch_updates))
         idx = rng.choice(self.K, size=int(self.C * self.K), replace=False)
+        ids = np.array(ids + [self.ids[i] for i in idx], dtype=int)
+        if self.stacked:
+            all_updates = self._stacked_update(params, idx, return_weights, all_updates)
+        elif self.vectorize:
+            all_updates.extend(self._vectorized_update(params, idx, return_weights))
+        else:
+            all_updates.extend([self._client_update(params, i, return_weights) for i in idx])
+        all_updates = updates.with_ids(all_updates, ids)
+        all_updates = ymirlib.chain(self.update_transform_chain, all_updates)
+        if updates.get_ids(all_updates) is None and len(all_updates) == len(ids):
+            all_updates = updates.with_ids(all_updates, ids)
+        return all_updates
+
+    def _client_update(self, params, i, return_weights):
+        """Perform the local training of the ith client and return its weights or sum of gradients"""
+        c = self.clients[i]
+        if scout.is_standard(c) and isinstance(c.data, datasets.DeviceDataIter):
+            sum_grads, c.opt_state, p = scout.sample_train(
+                c.opt, c.loss, c.batch_size, c.epochs, params, c.opt_state, c.data.next_key(),
+                c.data.X, c.data.y, c.data.idx, c.data.length, c.data.scale, c.data.offset
+            )
+            return self._transport(params, sum_grads, p, return_weights)
+        if scout.is_standard(c):
+            sum_grads, c.opt_state, p = scout.train(
+                c.opt, c.loss, params, c.opt_state, *_draw(c), c.data.scale, c.data.offset
+            )
+            return self._transport(params, sum_grads, p, return_weights)
+        p = params
+        sum_grads = None
+        for _ in range(c.epochs):
+            grads, c.opt_state, updates = c.update(p, c.opt_state, *next(c.data))
+            p = optax.apply_updates(p, updates)
+            sum_grads = grads if sum_grads is None else ymirlib.tree_add(sum_grads, grads)
+        return self._transport(params, sum_grads, p, return_weights)
+
+    def _transport(self, params, sum_grads, p, return_weights):
+        """
+        Get the update that clients send up the chain from their sum of gradients and weights, p, which may be stacked
+        along a leading axis
+        """
+        if not return_weights:
+            return sum_grads
+        return _difference(p, params) if self.delta else p
+
+    def _vectorized_update(self, params, idx, return_weights, flatten=False):
+        """
+        Perform the local training of the clients at idx, where the standard clients that are able to share a training
+        step are stacked and trained together. The updates are returned in the same order as idx, either as a list of
+        pytrees or, if flatten is True, as a matrix with a row for each client.
+        """
+        groups = {}
+        results = {}
+        stacks = []
         for i in idx:
-            p = params
-            sum_grads = None
-            for _ in range(self.clients[i].epochs):
-                grads, self.clients[i].opt_state, updates = self.clients[i].update(p, self.clients[i].opt_state, *next(self.clients[i].data))
-                p = optax.apply_updates(p, updates)
-                sum_grads = grads if sum_grads is None else ymirlib.tree_add(sum_grads, grads)
-            all_updates.append(p if return_weights else sum_grads)
-        return ymirlib.chain(self.update_transform_chain, all_updates)
+            c = self.clients[i]
+            if scout.is_standard(c):
+                device_data = id(c.data.X) if isinstance(c.data, datasets.DeviceDataIter) else None
+                norm = (c.data.scale, c.data.offset)
+                groups.setdefault((c.opt, c.loss, c.batch_size, c.epochs, device_data, norm), []).append(i)
+            else:
+                results[i] = self._client_update(params, i, return_weights)
+        for (opt, loss, batch_size, epochs, device_data, (scale, offset)), group in groups.items():
+            clients = [self.clients[i] for i in group]
+            stacked_params = ymirlib.tree_stack([params for _ in clients])
+            opt_state = ymirlib.tree_stack([c.opt_state for c in clients])
+            if device_data is None:
+                draws = [_draw(c) for c in clients]
+                if len({X.dtype for X, _ in draws}) > 1:
+                    # Mapped data is drawn already normalized, so it cannot be stacked with samples of the stored type
+                    draws = [(datasets.normalize(X, scale, offset), y) for X, y in draws]
+                X, y = (jnp.stack(b) for b in zip(*draws))
+                sum_grads, opt_state, p = scout.batch_train(opt, loss, stacked_params, opt_state, X, y, scale, offset)
+            else:
+                data = [c.data for c in clients]
+                max_length = max(d.length for d in data)
+                sum_grads, opt_state, p = scout.batch_sample_train(
+                    opt, loss, batch_size, epochs, stacked_params, opt_state,
+                    jnp.stack([d.next_key() for d in data]), data[0].X, data[0].y,
+                    jnp.stack([jnp.pad(d.idx, (0, max_length - d.length)) for d in data]), jnp.array([d.length for d in data]),
+                    scale, offset
+                )
+            for c, s in zip(clients, ymirlib.tree_unstack(opt_state, len(clients))):
+                c.opt_state = s
+            stacks.append((group, self._transport(params, sum_grads, p, return_weights)))
+        if not flatten:
+            for group, stack in stacks:
+                results.update(zip(group, ymirlib.tree_unstack(stack, len(group))))
+            return [results[i] for i in idx]
+        if results:
+            stacks.append((list(results.keys()), ymirlib.tree_stack(list(results.values()))))
+        position = {i: p for p, i in enumerate(i for group, _ in stacks for i in group)}
+        G = jnp.concatenate([updates.ravel_stacked(stack) for _, stack in stacks])
+        return G[np.array([position[i] for i in idx])]
+
+    def _stacked_update(self, params, idx, return_weights, all_updates):
+        """Perform the local training of the clients at idx and return the updates appended to all_updates as an UpdateMatrix"""
+        if self.unraveller is None:
+            self.unraveller = jax.flatten_util.ravel_pytree(params)[1]
+        matrices = [updates.as_matrix(all_updates, self.unraveller).G] if len(all_updates) > 0 else []
+        if len(idx) > 0:
+            if self.vectorize:
+                matrices.append(self._vectorized_update(params, idx, return_weights, flatten=True))
+            else:
+                matrices.append(updates.ravel_stacked(ymirlib.tree_stack([self._client_update(params, i, return_weights) for i in idx])))
+        return updates.UpdateMatrix(jnp.concatenate(matrices), self.unraveller)
+
+
+def _draw(client):
+    """
+    Draw the batches for each of the client's local epochs, stacked along a leading axis. The samples are left in their
+    stored type, to be transferred as such and normalized on device within the fused training.
+    """
+    return client.data.next_n(client.epochs, raw=True)
+
+
+@jax.jit
+def _difference(tree, origin):
+    """Subtract the origin pytree from the tree, broadcasting over any leading axes of the tree's leaves"""
+    return jax.tree_multimap(jnp.subtract, tree, origin)
 
 
 class Network:
     """Higher level class for tracking each controller and client"""
-    def __init__(self, C=1.0):
+    def __init__(self, C=1.0, vectorize=False, stacked=False, delta=False):
         """Construct the Network.
 
         Arguments:
         - C: percent of clients to randomly select for training at each round
+        - vectorize: if True, the controllers train compatible clients together with a single vectorized update step
+        - stacked: if True, the controllers return their updates as a single `ymir.mp.updates.UpdateMatrix`
+        - delta: if True, clients asked for their weights instead send the difference between their weights and the
+          global parameters, which the captains reconstruct from only where needed
         """
         self.clients = []
         self.controllers = {}
         self.server_name = ""
         self.C = C
+        self.vectorize = vectorize
+        self.stacked = stacked
+        self.delta = delta
 
     def __len__(self):
         """Get the number of clients in the network"""
@@ -87,7 +249,7 @@ class Network:
 
     def add_controller(self, name, server=False):
         """Add a new controller with name into this network"""
-        self.controllers[name] = Controller(self.C)
+        self.controllers[name] = Controller(self.C, self.vectorize, self.stacked, self.delta)
         if server:
             self.server_name = name
     
@@ -96,14 +258,18 @@ class Network:
         return self.controllers[name]
 
     def add_host(self, controller_name, client):
-        """Add a client to the specified controller in this network"""
+        """Add a client to the specified controller in this network, the client's id is its position in the network"""
+        self.controllers[controller_name].add_client(client, len(self.clients))
         self.clients.append(client)
-        self.controllers[controller_name].add_client(client)
 
     def connect_controllers(self, from_con, to_con):
         """Connect two controllers in this network"""
         self.controllers[from_con].add_switch(self.controllers[to_con])
 
+    def prefetch(self, depth=2):
+        """Prefetch the batches of each of the clients in the network in the background, keeping depth rounds of batches staged"""
+        self.controllers[self.server_name].prefetch(depth)
+
     def __call__(self, params, rng=np.random.default_rng(), return_weights=False):
         """
         Perform an update step across the network and return the respective updates
@@ -111,6 +277,7 @@ class Network:
         Arguments:
         - params: the parameters of the global model from the most recent round
         - rng: the random number generator to use
-        - return_weights: if True, return the weights of the clients else return the gradients from the local training
+        - return_weights: if True, return the weights of the clients, or their differences from params in delta mode, else
+          return the gradients from the local training
         """
         return self.controllers[self.server_name](params, rng, return_weights)
\ No newline at end of file
@@ -0,0 +1,207 @@
+r"""
+Stacked representation of the updates passed from the network to the captains.
+"""
+
+
+import jax
+import jax.flatten_util
+import jax.numpy as jnp
+
+import ymirlib
+
+
+class UpdateMatrix:
+    r"""
+    The updates of a collection of clients held as a single contiguous matrix $G \in \mathbb{R}^{n \times d}$, where each row
+    is a flattened client update, alongside the function to unravel a row back into the model's pytree structure.
+    Implements the sequence protocol, unravelling rows upon access, so it may be used wherever a list of updates is expected.
+    """
+    def __init__(self, G, unraveller, ids=None):
+        """
+        Construct the update matrix.
+
+        Arguments:
+        - G: the matrix of flattened updates, one row per client
+        - unraveller: function that converts a row of G back into a pytree
+
+        Optional arguments:
+        - ids: the ids of the clients that each of the rows are from
+        """
+        self.G = G
+        self.unraveller = unraveller
+        self.ids = ids
+
+    def __len__(self):
+        return self.G.shape[0]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.unraveller(g) for g in self.G[i]]
+        return self.unraveller(self.G[i])
+
+    def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            self.G = self.G.at[i].set(jnp.stack([ymirlib.tree_flatten(v) for v in value]))
+        else:
+            self.G = self.G.at[i].set(ymirlib.tree_flatten(value))
+
+    def __iter__(self):
+        return (self.unraveller(g) for g in self.G)
+
+    def scale(self, alpha):
+        """Scale each of the rows by the respective value of alpha"""
+        return UpdateMatrix(_scale(alpha, self.G), self.unraveller, self.ids)
+
+    def sum(self):
+        """Element-wise sum the updates into a single pytree"""
+        return self.unraveller(jnp.sum(self.G, axis=0))
+
+    def weighted_sum(self, alpha):
+        r"""Find the alpha weighted sum of the updates, $\alpha^\top G$, as a single pytree"""
+        return self.unraveller(alpha @ self.G)
+
+
+class Updates(list):
+    """
+    A list of client updates along with the ids of the clients that they are from, allowing the captains to attribute
+    each update to its client when only a portion of the clients participate in a round.
+    """
+    def __init__(self, all_updates=(), ids=None):
+        """
+        Construct the list of updates.
+
+        Arguments:
+        - all_updates: the update pytrees
+        - ids: the ids of the clients that each of the updates are from
+        """
+        super().__init__(all_updates)
+        self.ids = ids
+
+
+@jax.jit
+def _scale(alpha, G):
+    return alpha[:, None] * G
+
+
+@jax.jit
+def ravel_stacked(tree):
+    """Flatten a pytree with a leading axis indexing the clients into a matrix with a row for each client"""
+    return jax.vmap(lambda t: jax.flatten_util.ravel_pytree(t)[0])(tree)
+
+
+def as_matrix(all_updates, unraveller=None):
+    """
+    Get the UpdateMatrix form of a collection of updates, the updates are returned as is if already in that form.
+
+    Arguments:
+    - all_updates: a list of update pytrees or an UpdateMatrix
+    - unraveller: the function to unravel rows back into pytrees, found from the first update if not specified
+    """
+    if isinstance(all_updates, UpdateMatrix):
+        return all_updates
+    if unraveller is None:
+        unraveller = jax.flatten_util.ravel_pytree(all_updates[0])[1]
+    return UpdateMatrix(ravel_stacked(ymirlib.tree_stack(list(all_updates))), unraveller, get_ids(all_updates))
+
+
+def norms(all_updates, origin=None):
+    """
+    Find the $l_2$ norm of each of the updates, leaf by leaf when they are pytrees.
+
+    Arguments:
+    - all_updates: a list of update pytrees or an UpdateMatrix
+
+    Optional arguments:
+    - origin: if specified, find the norms of the differences between each of the updates and this pytree
+    """
+    if isinstance(all_updates, UpdateMatrix):
+        return _norms(all_updates.G, None if origin is None else ymirlib.tree_flatten(origin))
+    return ymirlib.tree_norms(list(all_updates), origin)
+
+
+def gram(all_updates, block_size=None, offset=None):
+    r"""
+    Find the Gram matrix of the updates, leaf by leaf when they are pytrees.
+
+    Arguments:
+    - all_updates: a list of update pytrees or an UpdateMatrix
+
+    Optional arguments:
+    - block_size: if specified, compute the Gram matrix in blocks of this many rows
+    - offset: if specified, find the Gram matrix of the updates offset by this pytree, $x_i + o$, such as the weights
+      reconstructed from delta updates, from the Gram matrix of the updates without forming the offset updates
+    """
+    if isinstance(all_updates, UpdateMatrix):
+        K = ymirlib.gram(all_updates.G, block_size)
+    else:
+        K = ymirlib.tree_gram(list(all_updates), block_size)
+    if offset is None:
+        return K
+    return _offset_gram(K, _inner(all_updates, offset), ymirlib.tree_flatten(offset))
+
+
+def weighted_sum(all_updates, alpha, offset=None):
+    """
+    Find the alpha weighted sum of the updates as a single pytree
+
+    Optional arguments:
+    - offset: if specified, find the weighted sum of the updates offset by this pytree without forming the offset updates
+    """
+    if isinstance(all_updates, UpdateMatrix):
+        total = all_updates.weighted_sum(alpha)
+    else:
+        total = ymirlib.tree_weighted_sum(list(all_updates), alpha)
+    if offset is None:
+        return total
+    return _offset_sum(total, jnp.sum(alpha), offset)
+
+
+@jax.jit
+def _norms(G, origin=None):
+    return jnp.linalg.norm(G if origin is None else G - origin, axis=1)
+
+
+def _inner(all_updates, tree):
+    """Find the inner product of each of the updates with the pytree"""
+    if isinstance(all_updates, UpdateMatrix):
+        return _matrix_inner(all_updates.G, ymirlib.tree_flatten(tree))
+    return sum(_leaf_inner(x, o) for x, o in zip(ymirlib.tree_stack_leaves(list(all_updates)), jax.tree_leaves(tree)))
+
+
+@jax.jit
+def _matrix_inner(G, x):
+    return G @ x
+
+
+@jax.jit
+def _leaf_inner(x, o):
+    return x @ o.reshape(-1)
+
+
+@jax.jit
+def _offset_gram(K, inner, offset):
+    r"""Find $(x_i + o)^\top (x_j + o) = K_{ij} + x_i^\top o + x_j^\top o + o^\top o$"""
+    return K + inner[:, None] + inner[None, :] + offset @ offset
+
+
+@jax.jit
+def _offset_sum(total, scale, offset):
+    return jax.tree_multimap(lambda t, o: t + scale * o, total, offset)
+
+
+def get_ids(all_updates):
+    """Get the ids of the clients that a collection of updates are from, None states that all clients are in order of id"""
+    return getattr(all_updates, "ids", None)
+
+
+def with_ids(all_updates, ids):
+    """
+    Attach the ids of the clients to a collection of updates.
+
+    Arguments:
+    - all_updates: a list of update pytrees or an UpdateMatrix
+    - ids: the ids of the clients that each of the updates are from
+    """
+    if isinstance(all_updates, UpdateMatrix):
+        return UpdateMatrix(all_updates.G, all_updates.unraveller, ids)
+    return Updates(all_updates, ids)
@@ -63,8 +63,7 @@ class GradientTransform:
 
     def __call__(self, all_grads):
         """Update each connected client and return the generated gradients. Recursively call in connected controllers"""
-        self.server.update(all_grads)
-        alpha = self.server.scale(all_grads)
+        alpha = garrison.captain.get_scale(self.server, all_grads)
         if self.should_toggle(alpha):
             self.attacking = not self.attacking
             for a in self.adversaries:
@@ -46,8 +46,7 @@ class GradientTransform:
 
     def __call__(self, all_grads):
         """Get the scale value and scale the gradients."""
-        self.server.update(all_grads)
-        alpha = np.array(self.server.scale(all_grads))
+        alpha = np.array(garrison.captain.get_scale(self.server, all_grads))
         idx = np.arange(len(alpha) - self.num_adv, len(alpha))[alpha[-self.num_adv:] > 0.0001]
         alpha[idx] = 1 / alpha[idx]
         for i in idx:
@@ -3,7 +3,13 @@ Standard endpoint collaborators for federated learning.
 """
 
 from functools import partial
+
 import jax
+import jax.numpy as jnp
+import optax
+
+import ymirlib
+from ymir.mp import datasets
 
 class Scout:
     """An endpoint for federated learning, holds its own data and personal learning variables."""
@@ -42,4 +48,104 @@ def update(opt, loss, params, opt_state, X, y):
     """
     grads = jax.grad(loss)(params, X, y)
     updates, opt_state = opt.update(grads, opt_state, params)
-    return grads, opt_state, updates
\ No newline at end of file
+    return grads, opt_state, updates
+
+@partial(jax.jit, static_argnums=(0, 1,))
+def batch_update(opt, loss, params, opt_state, X, y):
+    """
+    Vectorized local learning step, performs the update of a stack of endpoints sharing an optimizer and loss function.
+    Each of the arguments besides opt and loss have a leading axis indexing the endpoints.
+
+    Arguments:
+    - opt: optimizer
+    - loss: loss function
+    - params: stacked model parameters
+    - opt_state: stacked optimizer states
+    - X: stacked samples
+    - y: stacked labels
+    """
+    return jax.vmap(partial(update, opt, loss))(params, opt_state, X, y)
+
+
+@partial(jax.jit, static_argnums=(0, 1,))
+def train(opt, loss, params, opt_state, X, y, scale=1.0, offset=0.0):
+    """
+    Fused local training, performs a local learning step for each batch along the leading axis of X and y within a single
+    compiled loop. Returns the sum of the gradients, the final optimizer state, and the final model parameters.
+
+    Arguments:
+    - opt: optimizer
+    - loss: loss function
+    - params: model parameters
+    - opt_state: optimizer state
+    - X: samples, with a leading axis indexing the epochs, integer typed samples are normalized within the training
+    - y: labels, with a leading axis indexing the epochs
+
+    Optional arguments:
+    - scale: the scale that normalizes integer typed samples
+    - offset: the offset added to the scaled integer typed samples
+    """
+    X = datasets.normalize(X, scale, offset)
+    def _epoch(carry, batch):
+        params, opt_state, sum_grads = carry
+        grads, opt_state, updates = update(opt, loss, params, opt_state, *batch)
+        return (optax.apply_updates(params, updates), opt_state, ymirlib.tree_add(sum_grads, grads)), None
+    (params, opt_state, sum_grads), _ = jax.lax.scan(_epoch, (params, opt_state, jax.tree_map(jnp.zeros_like, params)), (X, y))
+    return sum_grads, opt_state, params
+
+
+@partial(jax.jit, static_argnums=(0, 1,))
+def batch_train(opt, loss, params, opt_state, X, y, scale=1.0, offset=0.0):
+    """
+    Vectorized fused local training of a stack of endpoints sharing an optimizer and loss function, the stacked form
+    of train where each of the arguments besides opt, loss, scale, and offset have a leading axis indexing the endpoints.
+    """
+    return jax.vmap(partial(train, opt, loss), in_axes=(0, 0, 0, 0, None, None))(params, opt_state, X, y, scale, offset)
+
+
+@partial(jax.jit, static_argnums=(0, 1, 2, 3,))
+def sample_train(opt, loss, batch_size, epochs, params, opt_state, key, X, y, idx, length, scale, offset):
+    """
+    Fused local training upon device resident data, the batches for each epoch are sampled in-graph with the jax random
+    key and then trained upon as in train.
+
+    Arguments:
+    - opt: optimizer
+    - loss: loss function
+    - batch_size: the batch size
+    - epochs: the number of local epochs
+    - params: model parameters
+    - opt_state: optimizer state
+    - key: jax random key used for sampling
+    - X: all samples
+    - y: all labels
+    - idx: the indices of the client's samples, only the first length of which are valid
+    - length: the number of the client's samples
+    - scale: the scale that normalizes integer typed samples
+    - offset: the offset added to the scaled integer typed samples
+    """
+    X, y = datasets.sample(key, X, y, idx, length, batch_size, epochs)
+    return train(opt, loss, params, opt_state, X, y, scale, offset)
+
+
+@partial(jax.jit, static_argnums=(0, 1, 2, 3,))
+def batch_sample_train(opt, loss, batch_size, epochs, params, opt_state, key, X, y, idx, length, scale, offset):
+    """
+    Vectorized form of sample_train for a stack of endpoints, params, opt_state, key, idx, and length have a leading axis
+    indexing the endpoints while the data is shared.
+    """
+    return jax.vmap(
+        partial(sample_train, opt, loss, batch_size, epochs), in_axes=(0, 0, 0, None, None, 0, 0, None, None)
+    )(params, opt_state, key, X, y, idx, length, scale, offset)
+
+
+def is_standard(client):
+    """
+    Check whether the client performs the standard local learning step with its own optimizer and loss function, that
+    is, its update has not been replaced or rebound, such as by an adversary. Only such clients may have their training
+    fused, which is performed with the client's optimizer and loss function rather than its update.
+    """
+    return (
+        isinstance(client.update, partial) and client.update.func is update and not client.update.keywords
+        and len(client.update.args) == 2 and client.update.args[0] is client.opt and client.update.args[1] is client.loss
+    )
@@ -1,6 +1,7 @@
 from functools import partial
 
 import jax
+import jax.numpy as jnp
 import numpy as np
 
 """
@@ -40,4 +41,128 @@ def tree_add(*trees):
 @jax.jit
 def tree_flatten(tree):
     """Flatten a pytree into a vector"""
-    return jax.flatten_util.ravel_pytree(tree)[0]
\ No newline at end of file
+    return jax.flatten_util.ravel_pytree(tree)[0]
+
+
+def tree_stack(trees):
+    """
+    Stack a list of equivalently structured pytrees into a single pytree with a new leading axis. This is done leaf by
+    leaf outside of jit, so that a jitted function taking the result neither unrolls over the pytrees nor is traced anew
+    for each leaf of each of them.
+    """
+    return jax.tree_multimap(lambda *xs: jnp.stack(xs), *trees)
+
+
+def tree_unstack(tree, n=None):
+    """Split a pytree with a leading axis of length n into a list of pytrees, inverse of tree_stack"""
+    if n is None:
+        n = jax.tree_leaves(tree)[0].shape[0]
+    return [jax.tree_map(lambda x: x[i], tree) for i in range(n)]
+
+
+@partial(jax.jit, static_argnums=(1,))
+def gram(X, block_size=None):
+    r"""
+    Find the Gram matrix, $X X^\top$, of the rows of X in float32.
+
+    Arguments:
+    - X: the matrix to find the Gram matrix of
+
+    Optional arguments:
+    - block_size: if specified, compute the Gram matrix in blocks of this many rows, bounding the size of the intermediates
+    """
+    X = X.astype(jnp.float32)
+    n = X.shape[0]
+    if block_size is None or block_size >= n:
+        return X @ X.T
+    nblocks = -(-n // block_size)
+    Xb = jnp.pad(X, ((0, nblocks * block_size - n), (0, 0))).reshape(nblocks, block_size, -1)
+    return jax.lax.map(lambda b: b @ X.T, Xb).reshape(-1, n)[:n]
+
+
+@partial(jax.jit, donate_argnums=(0,))
+def gram_update_rows(K, X, ids):
+    """
+    Update the Gram matrix K of the rows of X after the rows at ids have changed, at a cost proportional to the number of
+    changed rows rather than the number of rows of X.
+
+    Arguments:
+    - K: the Gram matrix prior to the change, its memory is reused for the result
+    - X: the matrix after the change
+    - ids: the indices of the changed rows
+    """
+    rows = X[ids].astype(jnp.float32) @ X.T.astype(jnp.float32)
+    return K.at[ids].set(rows).at[:, ids].set(rows.T)
+
+
+@jax.jit
+def cosine_from_gram(K):
+    """Find the pairwise cosine similarity from a Gram matrix, rows of zeros have a similarity of 0 to all rows"""
+    norms = jnp.sqrt(jnp.diag(K))
+    norms = jnp.where(norms == 0, 1, norms)
+    # Clip away the rounding error that would otherwise place similarities outside of [-1, 1]
+    return jnp.clip(K / norms[:, None] / norms[None, :], -1, 1)
+
+
+@partial(jax.jit, static_argnums=(1,))
+def cosine_similarity(X, block_size=None):
+    """
+    Find the pairwise cosine similarity of the rows of X in float32, rows of zeros have a similarity of 0 to all rows.
+
+    Optional arguments:
+    - block_size: if specified, compute the similarities in blocks of this many rows
+    """
+    return cosine_from_gram(gram(X, block_size))
+
+
+def tree_stack_leaves(trees):
+    """
+    Iterate over the leaves of a list of equivalently structured pytrees, stacking each into a matrix with a row per
+    pytree only when it is reached. The leaves are in the order used by `jax.flatten_util.ravel_pytree`. The reductions
+    below consume each stacked leaf before the next is formed, so only a single stacked leaf is held at a time.
+    """
+    for xs in zip(*[jax.tree_leaves(t) for t in trees]):
+        yield jnp.stack(xs).reshape(len(xs), -1)
+
+
+def tree_norms(trees, origin=None):
+    """
+    Find the $l_2$ norm of each of a list of pytrees, accumulated leaf by leaf so the pytrees are never flattened.
+
+    Optional arguments:
+    - origin: if specified, find the norms of the differences between each of the pytrees and this pytree
+    """
+    origins = [None] * len(jax.tree_leaves(trees[0])) if origin is None else jax.tree_leaves(origin)
+    return jnp.sqrt(sum(leaf_sq_norms(x, o) for x, o in zip(tree_stack_leaves(trees), origins)))
+
+
+@jax.jit
+def leaf_sq_norms(x, origin=None):
+    """Find the squared $l_2$ norm of each row of a stacked leaf, or of its difference from the origin leaf"""
+    if origin is not None:
+        x = x - origin.reshape(-1)
+    return jnp.sum(x.astype(jnp.float32)**2, axis=1)
+
+
+def tree_gram(trees, block_size=None):
+    """
+    Find the Gram matrix of a list of pytrees, accumulated leaf by leaf so the pytrees are never flattened.
+
+    Optional arguments:
+    - block_size: if specified, compute each leaf's contribution in blocks of this many rows
+    """
+    return sum(gram(x, block_size) for x in tree_stack_leaves(trees))
+
+
+def tree_weighted_sum(trees, alpha):
+    """Find the alpha weighted sum of a list of pytrees, leaf by leaf"""
+    leaves, treedef = jax.tree_flatten(trees[0])
+    return jax.tree_unflatten(
+        treedef, [leaf_weighted_sum(x, alpha).reshape(l.shape) for x, l in zip(tree_stack_leaves(trees), leaves)]
+    )
+
+
+@jax.jit
+def leaf_weighted_sum(x, alpha):
+    """Find the alpha weighted sum of the rows of a stacked leaf"""
+    return jnp.tensordot(alpha, x, axes=1)